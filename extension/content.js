@@ -12,6 +12,8 @@ var politicalColors = {
 }
 var mouseOverMisinformation = false;
 var mouseOverJournalist = false;
+var serverUrl = "http://localhost:8080";
+var checkedParagraphs = new Set();
 
 function highlightMisinfo(data) {
     var context = document.body; // requires an element with class "context" to exist
@@ -161,28 +163,129 @@ function updatePage() {
         }
     }
 
+    if (window.crypto && window.crypto.subtle) {
+        checkParagraphs(splitIntoParagraphs(sentenceQueue), pageChecked);
+    }
+    else {
+        postJSON(serverUrl + "/api", sentenceQueue, pageChecked, function () {
+            // Still clear the queue and watch for new nodes
+            pageChecked([]);
+        });
+    }
+    getJournalists();
+}
+
+function pageChecked(misinformationData) {
+    highlightMisinfo(misinformationData);
+    highlightJournalists();
+    sentenceQueue = [];
+    if (original == true) {
+        initiateAddedNodes();
+    }
+    original = false;
+    chrome.runtime.sendMessage({
+        type: "pageUpdated"
+    });
+    chrome.runtime.sendMessage({
+        type: "sendPercent",
+        percent: parseInt(100 * (misinfoWords / totalWords), 10)
+    });
+}
+
+function postJSON(url, body, callback, onError) {
     var xmlHttp = new XMLHttpRequest();
-    xmlHttp.open("POST", "http://localhost:8080/api", true);
+    xmlHttp.open("POST", url, true);
     xmlHttp.setRequestHeader("Content-Type", "application/json");
-    xmlHttp.onload = function(e) {
-        var misinformationData = JSON.parse(xmlHttp.responseText);
-        highlightMisinfo(misinformationData);
-        highlightJournalists();
-        sentenceQueue = [];
-        if (original == true) {
-            initiateAddedNodes();
+    xmlHttp.onload = function (e) {
+        var data;
+        try {
+            data = JSON.parse(xmlHttp.responseText);
         }
-        original = false;
-        chrome.runtime.sendMessage({
-            type: "pageUpdated"
-        });
-        chrome.runtime.sendMessage({
-            type: "sendPercent",
-            percent: parseInt(100 * (misinfoWords / totalWords), 10)
+        catch (error) {
+            data = null;
+        }
+        if (xmlHttp.status != 200 || data === null) {
+            onError();
+            return;
+        }
+        callback(data);
+    };
+    xmlHttp.onerror = function (e) {
+        onError();
+    };
+    xmlHttp.send(JSON.stringify(body));
+}
+
+function splitIntoParagraphs(texts) {
+    // Split the same way the server splits text into sections
+    var paragraphs = [];
+    for (var i = 0; i < texts.length; i++) {
+        var sections = texts[i].split(/[\t\n\r\xa0\x0b\x0c]/);
+        for (var j = 0; j < sections.length; j++) {
+            if (sections[j].length >= 15 && paragraphs.indexOf(sections[j]) < 0) {
+                paragraphs.push(sections[j]);
+            }
+        }
+    }
+    return paragraphs;
+}
+
+function hashParagraph(text) {
+    return crypto.subtle.digest("SHA-256", new TextEncoder().encode(text)).then(function (buffer) {
+        return Array.from(new Uint8Array(buffer)).map(function (b) {
+            return b.toString(16).padStart(2, "0");
+        }).join("");
+    });
+}
+
+function checkParagraphs(paragraphs, callback) {
+    // If the hash protocol fails, check the paragraphs through /api instead
+    var fallback = function () {
+        postJSON(serverUrl + "/api", paragraphs, callback, function () {
+            callback([]);
         });
     };
-    xmlHttp.send(JSON.stringify(sentenceQueue));
-    getJournalists();
+    Promise.all(paragraphs.map(hashParagraph)).then(function (hashes) {
+        // Skip the paragraphs that were already checked on this page
+        var paragraphsByHash = {};
+        var newHashes = [];
+        for (var i = 0; i < hashes.length; i++) {
+            if (!checkedParagraphs.has(hashes[i]) && !(hashes[i] in paragraphsByHash)) {
+                paragraphsByHash[hashes[i]] = paragraphs[i];
+                newHashes.push(hashes[i]);
+            }
+        }
+
+        var finish = function (results) {
+            var misinformationData = [];
+            for (var i = 0; i < newHashes.length; i++) {
+                checkedParagraphs.add(newHashes[i]);
+                if (results[newHashes[i]]) {
+                    misinformationData = misinformationData.concat(results[newHashes[i]]);
+                }
+            }
+            callback(misinformationData);
+        };
+
+        // Send the hashes first, and only send the text of the paragraphs the server has not seen
+        postJSON(serverUrl + "/api/paragraphs", { "hashes": newHashes }, function (known) {
+            if (!Array.isArray(known.missing)) {
+                fallback();
+                return;
+            }
+            if (known.missing.length == 0) {
+                finish(known.results);
+                return;
+            }
+            var upload = {};
+            for (var i = 0; i < known.missing.length; i++) {
+                upload[known.missing[i]] = paragraphsByHash[known.missing[i]];
+            }
+            postJSON(serverUrl + "/api/paragraphs", { "hashes": known.missing, "paragraphs": upload }, function (uploaded) {
+                finish(Object.assign(known.results, uploaded.results));
+            }, fallback);
+        }, fallback);
+    }, fallback);
 }
 
 function getCoords(node) {
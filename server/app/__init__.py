@@ -1,4 +1,4 @@
-from flask import Flask, request, jsonify, render_template, flash, redirect, url_for, session
+from flask import Flask, request, jsonify, render_template, flash, redirect, url_for, session, Response, stream_with_context
 from flask_cors import CORS
 from flask_bcrypt import Bcrypt
 
@@ -8,8 +8,13 @@ from datetime import date
 with open("config.json", "r") as f:
     config = json.load(f)
 
-from app.parsing.parser import parse_into_sentences, Misinformation
-from app.database.utils import get_similar_misinformation, load_structures, trees, construct_trees_from_database
+from app.parsing.parser import Misinformation
+from app.database.utils import ensure_structures, add_vectors_to_index, schedule_rebuild
+from app.pipeline import check_articles, iter_check_articles, check_paragraphs, paragraph_digest
+from app.database.cache import verdict_cache
+from app.parsing.encoders import get_padding_stats
+from app.parsing.sentence import get_proposition_stats
+from app.jobs import submit_job, get_job
 from app.website.forms import RegistrationForm, LoginForm, PostForm, CommentForm
 from app.website.db import conn, open_database, add_user_to_database, get_user_info, add_post_to_database, get_post_from_id, set_post, get_all_posts
 
@@ -24,25 +29,91 @@ app.config["SECRET_KEY"] = 'd49af5cebe80eb62333ff9b8639825c2'
 def api():
     """
     Endpoint for the factchecking api
+    Send ?stream=1 or Accept: application/x-ndjson to get one JSON record
+    per line as soon as each one is ready
     """
     # If the ANN trees are not loaded in, load them in
-    if trees == None:
-        load_structures()
-    # Parse the innerText for sentences and encode them
+    ensure_structures()
+    # Parse the innerText for sentences, encode and search them
     article_arr = request.get_json()
-    sentences = []
-    for article in article_arr:
-        sentences += parse_into_sentences(article)
-    # Return result
-    res = []
-    for sentence in sentences:
-        search = get_similar_misinformation(sentence)
-        if len(search) > 0:
-            res.append({
-                "sentence": str(sentence),
-                "results": search
-            })
-    return jsonify(res)
+    if request.args.get("stream") in ("1", "true") or "application/x-ndjson" in request.headers.get("Accept", ""):
+        def generate():
+            for record in iter_check_articles(article_arr, config["stream_chunk_size"]):
+                yield json.dumps(record) + "\n"
+        return Response(stream_with_context(generate()), mimetype="application/x-ndjson")
+    return jsonify(check_articles(article_arr))
+
+
+@app.route("/api/paragraphs", methods=["POST"])
+def api_paragraphs():
+    """
+    Incremental endpoint for the factchecking api
+    The extension sends {"hashes": [...]} with the SHA-256 of each paragraph. The server answers
+    with the results it already has and the hashes it is "missing", which the extension sends
+    again with {"hashes": [...], "paragraphs": {hash: text}}
+    """
+    ensure_structures()
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        return jsonify({"error": "Expected a JSON object"}), 400
+    paragraphs = data.get("paragraphs", {})
+    hashes = data.get("hashes", [])
+    if not isinstance(paragraphs, dict) or not all(isinstance(paragraph, str) for paragraph in paragraphs.values()):
+        return jsonify({"error": "paragraphs must map hashes to texts"}), 400
+    if not isinstance(hashes, list) or not all(isinstance(digest, str) for digest in hashes):
+        return jsonify({"error": "hashes must be a list of strings"}), 400
+    for digest, paragraph in paragraphs.items():
+        try:
+            matches = paragraph_digest(paragraph) == digest
+        except UnicodeEncodeError:
+            # JSON can carry lone surrogates, which are not valid UTF-8
+            return jsonify({"error": "Paragraph is not valid unicode"}), 400
+        if not matches:
+            return jsonify({"error": "Paragraph does not match its hash"}), 400
+    results = check_paragraphs(paragraphs)
+    missing = []
+    for digest in hashes:
+        if digest in results:
+            continue
+        verdict = verdict_cache.get_digest(digest)
+        if verdict is None:
+            missing.append(digest)
+        else:
+            results[digest] = verdict
+    return jsonify({"results": results, "missing": missing})
+
+
+@app.route("/api/stats")
+def api_stats():
+    """
+    Returns counters that show how efficiently the server is working
+    """
+    return jsonify({
+        "encoding": get_padding_stats(),
+        "propositions": get_proposition_stats(),
+        "verdict_cache": {"hits": verdict_cache.hits, "misses": verdict_cache.misses}
+    })
+
+
+@app.route("/api/jobs", methods=["POST"])
+def api_submit_job():
+    """
+    Queues a page scan and returns its job id right away
+    """
+    ensure_structures()
+    article_arr = request.get_json()
+    return jsonify({"id": submit_job(article_arr)}), 202
+
+
+@app.route("/api/jobs/<job_id>")
+def api_get_job(job_id):
+    """
+    Returns the status of a page scan and the results found so far
+    """
+    job = get_job(job_id)
+    if job is None:
+        return jsonify({"error": "Unknown or expired job"}), 404
+    return jsonify(job.to_dict())
 
 
 @app.route("/")
@@ -167,7 +238,10 @@ def add_to_database(post_id):
         if not conn:
             open_database()
         post = get_post_from_id(int(post_id))
-        Misinformation(post['misinfo'], post["link"], post["info"])
-        construct_trees_from_database()
+        ensure_structures()
+        misinfo = Misinformation(post['misinfo'], post["link"], post["info"])
+        # Searchable right away, the trees catch up in the background
+        add_vectors_to_index(range(misinfo.start, misinfo.end + 1), misinfo.embeddings)
+        schedule_rebuild()
         flash("Added to post information to misinformation database", "success")
     return redirect(url_for("homepage"))    
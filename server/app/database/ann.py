@@ -0,0 +1,281 @@
+import numpy as np
+from annoy import AnnoyIndex
+from app import config
+from app.database.codecs import create_codec, squared_norms, assign, kmeans
+from app.database.vectors import get_vectors
+
+
+class AnnoyBackend():
+    """
+    Approximate search with Annoy's forest of random projection trees.
+    Annoy keeps its own float32 copy of the vectors, so ann_encoding does not apply
+    """
+
+    # Settings that only change how the index is searched, they can be changed without a rebuild
+    query_settings = ("search_k",)
+
+    def __init__(self, dim, n_trees=None, search_k=None):
+        self.dim = dim
+        self.n_trees = n_trees if n_trees is not None else config["n_trees"]
+        self.search_k = search_k if search_k is not None else config["search_k"]
+        self.index = AnnoyIndex(dim, "euclidean")
+
+    def build(self, keys, vectors, chunk_size=10000):
+        """
+        Builds the index from an (N,) array of keys and an (N, dim) array of vectors
+        """
+        for i in range(0, len(keys), chunk_size):
+            for key, vector in zip(keys[i:i + chunk_size], vectors[i:i + chunk_size]):
+                self.index.add_item(int(key), vector)
+        self.index.build(self.n_trees)
+
+    def save(self, path):
+        # Saving also memory maps the file back in
+        self.index.save(path)
+
+    def load(self, path):
+        self.index.load(path)
+
+    def paths(self, path):
+        """
+        Returns the files save writes for the given path
+        """
+        return [path]
+
+    def get_n_items(self):
+        """
+        Returns the largest key plus one
+        """
+        return self.index.get_n_items()
+
+    def query(self, vector, n):
+        """
+        Returns the keys of the n nearest vectors and their euclidean distances
+        """
+        return self.index.get_nns_by_vector(vector, n, search_k=self.search_k, include_distances=True)
+
+    def query_batch(self, vectors, n):
+        """
+        Searches every row of an (N, dim) matrix of vectors
+        Returns (N, n) arrays of keys and euclidean distances, nearest first, padded with -1 and inf
+        """
+        return stack_results([self.query(vector, n) for vector in vectors], n)
+
+
+class ExactBackend():
+    """
+    Exact brute force search with a matrix multiply over every vector.
+    With a compressed ann_encoding the search runs over the codes, and the rerank_k
+    best candidates are reranked on their float32 vectors from the vector store
+    """
+
+    query_settings = ("rerank_k",)
+
+    def __init__(self, dim, encoding=None, rerank_k=None):
+        self.dim = dim
+        self.codec = create_codec(encoding if encoding is not None else config["ann_encoding"], dim)
+        self.rerank_k = rerank_k if rerank_k is not None else config["rerank_k"]
+        # Looks up the float32 vectors of keys for reranking
+        self.exact_vectors = get_vectors
+        self.keys = np.zeros(0, dtype=np.int64)
+        self.codes = self.codec.encode(np.zeros((0, dim), dtype=np.float32))
+        self.norms = self.codec.norms(self.codes)
+
+    def build(self, keys, vectors, train_size=None):
+        if train_size is None:
+            train_size = config["ann_train_size"]
+        if len(keys) == 0:
+            return
+        rng = np.random.RandomState(0)
+        self.codec.train(sample(vectors, train_size, rng))
+        self.keys = np.asarray(keys, dtype=np.int64)
+        self.codes = self.codec.encode(vectors)
+        self.norms = self.codec.norms(self.codes)
+
+    def save(self, path):
+        np.save(path + ".keys.npy", self.keys)
+        np.save(path + ".codes.npy", self.codes)
+        np.savez(path + ".codec.npz", **self.codec.get_params())
+        self.load(path)
+
+    def load(self, path):
+        self.keys = np.load(path + ".keys.npy", mmap_mode="r")
+        self.codes = np.load(path + ".codes.npy", mmap_mode="r")
+        with np.load(path + ".codec.npz") as params:
+            self.codec.set_params(dict(params))
+        self.norms = self.codec.norms(self.codes)
+
+    def paths(self, path):
+        return [path + ".keys.npy", path + ".codes.npy", path + ".codec.npz"]
+
+    def get_n_items(self):
+        return int(self.keys.max()) + 1 if len(self.keys) else 0
+
+    def query(self, vector, n):
+        return self.search(slice(None), vector, n)
+
+    def query_batch(self, vectors, n, chunk_size=10000):
+        vectors = np.asarray(vectors, dtype=np.float32).reshape(-1, self.dim)
+        rerank = not self.codec.exact and self.rerank_k
+        k = max(n, self.rerank_k) if rerank else n
+        # Keep the k best of every row while going through the codes a chunk at a time
+        keys = np.zeros((len(vectors), 0), dtype=np.int64)
+        distances = np.zeros((len(vectors), 0), dtype=np.float32)
+        for i in range(0, len(self.keys), chunk_size):
+            chunk_distances = self.codec.distances_batch(self.codes[i:i + chunk_size], None if self.norms is None else self.norms[i:i + chunk_size], vectors)
+            chunk_keys = np.broadcast_to(np.asarray(self.keys[i:i + chunk_size]), chunk_distances.shape)
+            keys, distances = nearest_rows(np.hstack([keys, chunk_keys]), np.hstack([distances, chunk_distances]), k)
+        if rerank and keys.shape[1]:
+            # Look up the float32 vectors of all candidates at once
+            unique, inverse = np.unique(keys, return_inverse=True)
+            exact = self.exact_vectors(unique)[inverse.reshape(keys.shape)]
+            distances = np.stack([np.sum((exact[row] - vector) ** 2, axis=1) for row, vector in enumerate(vectors)])
+            keys, distances = nearest_rows(keys, distances, n)
+        return pad_results(keys, np.sqrt(np.maximum(distances, 0)), n)
+
+    def search(self, rows, vector, n):
+        """
+        Searches the given rows of the index
+        Returns the keys of the n nearest vectors and their euclidean distances
+        """
+        vector = np.asarray(vector, dtype=np.float32)
+        keys = self.keys[rows]
+        distances = self.codec.distances(self.codes[rows], None if self.norms is None else self.norms[rows], vector)
+        if not self.codec.exact and self.rerank_k:
+            keys, _ = nearest(keys, distances, max(n, self.rerank_k))
+            distances = np.sum((self.exact_vectors(keys) - vector) ** 2, axis=1)
+        keys, distances = nearest(keys, distances, n)
+        return keys.tolist(), np.sqrt(np.maximum(distances, 0)).tolist()
+
+
+class IVFBackend(ExactBackend):
+    """
+    Inverted file index: the vectors are clustered with k-means, and a query only
+    searches the vectors of the n_probe clusters whose centroids are closest to it
+    """
+
+    query_settings = ("n_probe", "rerank_k")
+
+    def __init__(self, dim, n_lists=None, n_probe=None, encoding=None, rerank_k=None, iterations=10):
+        super().__init__(dim, encoding, rerank_k)
+        self.n_lists = n_lists if n_lists is not None else config["ivf_lists"]
+        self.n_probe = n_probe if n_probe is not None else config["ivf_probe"]
+        self.iterations = iterations
+        self.centroids = np.zeros((0, dim), dtype=np.float32)
+        # The vectors are stored sorted by list, list i is offsets[i]:offsets[i + 1]
+        self.offsets = np.zeros(1, dtype=np.int64)
+
+    def build(self, keys, vectors, train_size=None, chunk_size=10000):
+        if train_size is None:
+            train_size = config["ann_train_size"]
+        n = len(keys)
+        if n == 0:
+            return
+        # Train the centroids on a sample
+        rng = np.random.RandomState(0)
+        training = sample(vectors, train_size, rng)
+        self.centroids = kmeans(training, min(self.n_lists, len(training)), self.iterations, rng)
+        # Assign every vector to its list, then sort them by list
+        lists = np.concatenate([assign(np.asarray(vectors[i:i + chunk_size], dtype=np.float32), self.centroids) for i in range(0, n, chunk_size)])
+        order = np.argsort(lists, kind="stable")
+        self.offsets = np.concatenate([[0], np.cumsum(np.bincount(lists, minlength=len(self.centroids)))]).astype(np.int64)
+        self.codec.train(training)
+        self.keys = np.asarray(keys, dtype=np.int64)[order]
+        self.codes = np.concatenate([self.codec.encode(vectors[order[i:i + chunk_size]]) for i in range(0, n, chunk_size)])
+        self.norms = self.codec.norms(self.codes)
+
+    def save(self, path):
+        np.save(path + ".centroids.npy", self.centroids)
+        np.save(path + ".offsets.npy", self.offsets)
+        super().save(path)
+
+    def load(self, path):
+        super().load(path)
+        self.centroids = np.load(path + ".centroids.npy")
+        self.offsets = np.load(path + ".offsets.npy")
+
+    def paths(self, path):
+        return super().paths(path) + [path + ".centroids.npy", path + ".offsets.npy"]
+
+    def query(self, vector, n):
+        if len(self.keys) == 0:
+            return [], []
+        # Pick the closest lists and search their vectors
+        probe = np.argsort(squared_norms(self.centroids) - 2 * self.centroids.dot(vector))[:self.n_probe]
+        rows = np.concatenate([np.arange(self.offsets[i], self.offsets[i + 1]) for i in probe])
+        return self.search(rows, vector, n)
+
+    def query_batch(self, vectors, n):
+        # Every vector probes its own lists
+        return stack_results([self.query(vector, n) for vector in vectors], n)
+
+
+backends = {
+    "annoy": AnnoyBackend,
+    "exact": ExactBackend,
+    "ivf": IVFBackend
+}
+
+
+def create_backend(name=None, **settings):
+    """
+    Creates an empty index of the backend named in the config
+    """
+    if name is None:
+        name = config["ann_backend"]
+    if name not in backends:
+        raise ValueError("Unknown ann backend {}, pick one of {}".format(name, ", ".join(backends)))
+    return backends[name](config["vector_dim"], **settings)
+
+
+def sample(vectors, size, rng):
+    """
+    Returns a random sample of the rows as a float32 array, in row order so memory mapped rows are read sequentially
+    """
+    return np.asarray(vectors[np.sort(rng.choice(len(vectors), min(len(vectors), size), replace=False))], dtype=np.float32)
+
+
+def nearest(keys, distances, n):
+    """
+    Returns the n keys with the smallest distances and their distances, nearest first
+    """
+    n = min(n, len(keys))
+    if n == 0:
+        return keys[:0], distances[:0]
+    top = np.argpartition(distances, n - 1)[:n]
+    top = top[np.argsort(distances[top])]
+    return keys[top], distances[top]
+
+
+def nearest_rows(keys, distances, n):
+    """
+    Like nearest, for every row of (N, M) arrays of keys and distances
+    """
+    n = min(n, distances.shape[1])
+    if n == 0:
+        return keys[:, :0], distances[:, :0]
+    top = np.argpartition(distances, n - 1, axis=1)[:, :n]
+    top = np.take_along_axis(top, np.argsort(np.take_along_axis(distances, top, axis=1), axis=1), axis=1)
+    return np.take_along_axis(keys, top, axis=1), np.take_along_axis(distances, top, axis=1)
+
+
+def pad_results(keys, distances, n):
+    """
+    Pads (N, M) arrays of keys and distances to n columns with -1 and inf
+    """
+    missing = n - keys.shape[1]
+    keys = np.hstack([keys, np.full((len(keys), missing), -1, dtype=np.int64)])
+    distances = np.hstack([distances, np.full((len(distances), missing), np.inf, dtype=np.float32)])
+    return keys.astype(np.int64), distances.astype(np.float32)
+
+
+def stack_results(results, n):
+    """
+    Turns a list of (keys, distances) results of single queries into padded (N, n) arrays
+    """
+    keys = np.full((len(results), n), -1, dtype=np.int64)
+    distances = np.full((len(results), n), np.inf, dtype=np.float32)
+    for row, (row_keys, row_distances) in enumerate(results):
+        keys[row, :len(row_keys)] = row_keys
+        distances[row, :len(row_distances)] = row_distances
+    return keys, distances
@@ -0,0 +1,200 @@
+import os
+import re
+import json
+import time
+import uuid
+import shutil
+import hashlib
+from contextlib import contextmanager
+from app import config
+try:
+    import fcntl
+except ImportError:
+    # Windows
+    fcntl = None
+    import msvcrt
+
+# Every build goes into its own directory under INDEX_DIR, next to a manifest describing it
+INDEX_DIR = os.path.join("app", "database", "indexes")
+# Holds the name of the directory in use
+CURRENT_PATH = os.path.join(INDEX_DIR, "current")
+MANIFEST_NAME = "manifest.json"
+# Held while building and publishing, so only one process rebuilds at a time
+LOCK_PATH = os.path.join(INDEX_DIR, "build.lock")
+# Published directories are named <milliseconds>-<random hex>
+ARTIFACT_NAME = re.compile(r"^(\d+)-[0-9a-f]+$")
+MODEL_DIR = os.path.join("app", "models")
+# Files the exporters in app/parsing/encoders.py write next to the model, they are derived from it
+EXPORTED_PATHS = (os.path.join(MODEL_DIR, "encoder.onnx"), os.path.join(MODEL_DIR, "encoder_int8.pt"))
+FORMAT = 1
+
+# The settings that change what gets built, the ones that only change searching are left out
+BUILD_SETTINGS = ("vector_dim", "ann_backend", "ann_encoding", "n_trees", "ivf_lists", "pq_subspaces", "ann_train_size")
+
+model_hash = None
+
+
+def get_config_hash():
+    """
+    Hashes the settings the index is built with
+    """
+    settings = [config[key] for key in BUILD_SETTINGS]
+    return hashlib.sha1(json.dumps(settings).encode("utf-8")).hexdigest()[:16]
+
+
+def get_model_hash():
+    """
+    Hashes the encoder model in app/models: the name and size of every file, and the contents of
+    the small ones. The weights are not read in full, that would take seconds
+    The torch, int8 and onnx backends all run this model, so the backend is left out
+    """
+    global model_hash
+    if model_hash is None:
+        h = hashlib.sha1()
+        for root, dirs, files in sorted(os.walk(MODEL_DIR)):
+            dirs.sort()
+            for name in sorted(files):
+                path = os.path.join(root, name)
+                if path in EXPORTED_PATHS:
+                    continue
+                size = os.path.getsize(path)
+                h.update("{}\0{}\0".format(os.path.relpath(path, MODEL_DIR), size).encode("utf-8"))
+                if size < 2 ** 20:
+                    with open(path, "rb") as f:
+                        h.update(f.read())
+        model_hash = h.hexdigest()[:16]
+    return model_hash
+
+
+def new_artifact():
+    """
+    Creates an empty directory for a build, hidden from get_current_artifact until publish_artifact
+    Returns its path
+    """
+    # The pid and a random part keep builds that start in the same millisecond apart
+    path = os.path.join(INDEX_DIR, ".building-{}-{}{}".format(int(time.time() * 1000), os.getpid(), uuid.uuid4().hex[:8]))
+    os.makedirs(path)
+    return path
+
+
+@contextmanager
+def build_lock():
+    """
+    Holds an exclusive lock on LOCK_PATH, shared by every process using INDEX_DIR.
+    The operating system drops it if the process dies
+    """
+    os.makedirs(INDEX_DIR, exist_ok=True)
+    with open(LOCK_PATH, "a+b") as f:
+        if fcntl:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        else:
+            f.seek(0)
+            while True:
+                try:
+                    msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+                    break
+                except OSError:
+                    # LK_LOCK gives up after 10 seconds
+                    pass
+        try:
+            yield
+        finally:
+            if fcntl:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+            else:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+def get_index_path(directory):
+    """
+    Returns the path the backend saves its files under, inside an artifact directory
+    """
+    return os.path.join(directory, "index")
+
+
+def publish_artifact(directory, backend, keys, encoder_hash):
+    """
+    Writes the manifest of a finished build, moves it to its final name and points CURRENT_PATH at it
+    keys: the vectorTable ids the index was built from
+    encoder_hash: the hash of the model the vectors were encoded with, see get_encoder_hash in database.py
+    Returns the final path of the directory
+    """
+    manifest = {
+        "format": FORMAT,
+        "backend": config["ann_backend"],
+        "files": [os.path.basename(path) for path in backend.paths(get_index_path(directory))],
+        "vector_count": len(keys),
+        "max_row_id": int(keys.max()) if len(keys) else 0,
+        "config_hash": get_config_hash(),
+        "model_hash": encoder_hash,
+        "created": time.time()
+    }
+    with open(os.path.join(directory, MANIFEST_NAME), "w") as f:
+        json.dump(manifest, f, indent=4)
+    final = os.path.join(INDEX_DIR, os.path.basename(directory).replace(".building-", ""))
+    os.rename(directory, final)
+    # Point at the new directory, os.replace is atomic
+    with open(CURRENT_PATH + ".tmp", "w") as f:
+        f.write(os.path.basename(final))
+    os.replace(CURRENT_PATH + ".tmp", CURRENT_PATH)
+    return final
+
+
+def get_current_artifact():
+    """
+    Returns the path of the artifact directory in use, or None if none was built yet
+    """
+    if not os.path.isfile(CURRENT_PATH):
+        return None
+    with open(CURRENT_PATH, "r") as f:
+        path = os.path.join(INDEX_DIR, f.read().strip())
+    return path if os.path.isdir(path) else None
+
+
+def read_manifest(directory):
+    """
+    Returns the manifest of an artifact directory, or None if it has none
+    """
+    try:
+        with open(os.path.join(directory, MANIFEST_NAME), "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def check_artifact(directory, conn, encoder_hash):
+    """
+    Checks that an artifact was built by this configuration and model, from the rows vectorTable still holds
+    Returns the manifest, and the reason the artifact cannot be used or None if it can
+    Rows added to vectorTable after the build do not make it stale, they are newer than max_row_id
+    """
+    manifest = read_manifest(directory)
+    if manifest is None or manifest.get("format") != FORMAT:
+        return manifest, "no readable manifest"
+    if not all(os.path.isfile(os.path.join(directory, name)) for name in manifest["files"]):
+        return manifest, "index files are missing"
+    if manifest["backend"] != config["ann_backend"] or manifest["config_hash"] != get_config_hash():
+        return manifest, "built with different index settings"
+    if manifest["model_hash"] != encoder_hash:
+        return manifest, "built from vectors of a different encoder model"
+    count = conn.execute("SELECT COUNT(*) FROM vectorTable WHERE id <= ?", (manifest["max_row_id"],)).fetchone()[0]
+    if count != manifest["vector_count"]:
+        return manifest, "vectorTable has {} rows up to id {}, the index has {}".format(count, manifest["max_row_id"], manifest["vector_count"])
+    return manifest, None
+
+
+def prune_artifacts(keep=None):
+    """
+    Removes all but the newest keep artifact directories, never the one in use
+    Older ones are kept for a while since other processes may still be loading them
+    """
+    if keep is None:
+        keep = config["index_keep"]
+    current = get_current_artifact()
+    names = sorted((name for name in os.listdir(INDEX_DIR) if ARTIFACT_NAME.match(name)), key=lambda name: int(ARTIFACT_NAME.match(name).group(1)), reverse=True)
+    for name in names[keep:]:
+        path = os.path.join(INDEX_DIR, name)
+        if current is None or os.path.abspath(path) != os.path.abspath(current):
+            # Mapped files are only unlinked, processes that still use them keep their pages
+            shutil.rmtree(path, ignore_errors=True)
@@ -0,0 +1,202 @@
+import os
+import json
+import time
+import shutil
+import inspect
+import tempfile
+import itertools
+import numpy as np
+from app import config
+from app.database.ann import backends, ExactBackend
+
+
+def load_corpus(source, n_queries, seed=0):
+    """
+    Returns the (keys, vectors) to index and the held out (N, vector_dim) query vectors
+    source: "database" for the vectors in vectorTable, or "synthetic:N" for N clustered random vectors
+    The queries are left out of the index, so a query never finds itself
+    """
+    rng = np.random.RandomState(seed)
+    if source == "database":
+        from app.database.database import open_database
+        from app.database.vectors import sync_vector_store, load_vector_matrix
+        open_database()
+        sync_vector_store()
+        keys, vectors = load_vector_matrix()
+        keys, vectors = np.asarray(keys, dtype=np.int64), np.asarray(vectors, dtype=np.float32)
+    elif source.startswith("synthetic:"):
+        n = int(source.split(":")[1]) + n_queries
+        centers = rng.normal(size=(max(1, n // 100), config["vector_dim"])).astype(np.float32)
+        vectors = centers[rng.randint(len(centers), size=n)] + 0.5 * rng.normal(size=(n, config["vector_dim"])).astype(np.float32)
+        keys = np.arange(1, n + 1, dtype=np.int64)
+    else:
+        raise ValueError("Unknown source {}, use database or synthetic:N".format(source))
+    held_out = np.zeros(len(keys), dtype=bool)
+    held_out[rng.choice(len(keys), min(n_queries, len(keys) - 1), replace=False)] = True
+    return keys[~held_out], vectors[~held_out], vectors[held_out]
+
+
+def get_ground_truth(keys, vectors, queries, k):
+    """
+    Returns the exact (len(queries), k) keys and distances
+    """
+    exact = ExactBackend(config["vector_dim"], encoding="float32")
+    exact.build(keys, vectors)
+    return exact.query_batch(queries, k)
+
+
+def get_index_bytes(backend):
+    """
+    Saves the index to a temporary directory and returns the size of its files
+    The backend is left memory mapped on the saved files, like it is in the server
+    """
+    directory = tempfile.mkdtemp()
+    path = os.path.join(directory, "index")
+    backend.save(path)
+    return directory, sum(os.path.getsize(p) for p in backend.paths(path))
+
+
+def get_grid(backend_class, settings):
+    """
+    Splits the settings into the combinations that need their own build, and the ones that
+    only change how the index is searched, keeping the settings the backend takes
+    """
+    accepted = inspect.signature(backend_class.__init__).parameters
+    build_keys = [key for key in settings if key in accepted and key not in backend_class.query_settings]
+    query_keys = [key for key in settings if key in accepted and key in backend_class.query_settings]
+    combinations = lambda keys: [dict(zip(keys, values)) for values in itertools.product(*[settings[key] for key in keys])]
+    return combinations(build_keys), combinations(query_keys)
+
+
+def run(source="synthetic:20000", names=None, settings=None, ks=None, max_dists=None, n_queries=200):
+    """
+    Builds an index for every combination of build settings of every backend, searches the held
+    out queries with every combination of search settings, and compares the results with the
+    exact ground truth. Returns one row per combination and (max_results_per_query, max_dist)
+    settings: dict from a backend's constructor argument to the list of values to try
+    """
+    names = names or [config["ann_backend"]]
+    settings = settings or {}
+    ks = ks or [config["max_results_per_query"]]
+    max_dists = max_dists or [config["max_dist"]]
+    keys, vectors, queries = load_corpus(source, n_queries)
+    truth_keys, truth_distances = get_ground_truth(keys, vectors, queries, max(ks))
+    rows = []
+    for name in names:
+        build_grid, query_grid = get_grid(backends[name], settings)
+        for build_settings in build_grid:
+            backend = backends[name](config["vector_dim"], **build_settings)
+            # Rerank on the benchmark's vectors rather than the vector store
+            backend.exact_vectors = lambda found: vectors[np.searchsorted(keys, found)]
+            start = time.perf_counter()
+            backend.build(keys, vectors)
+            build_time = time.perf_counter() - start
+            directory, index_bytes = get_index_bytes(backend)
+            for query_settings in query_grid:
+                for key, value in query_settings.items():
+                    setattr(backend, key, value)
+                for k in ks:
+                    found_keys, found_distances, latencies = [], [], []
+                    for query in queries:
+                        start = time.perf_counter()
+                        found, distances = backend.query(query, k)
+                        latencies.append(time.perf_counter() - start)
+                        found_keys.append(found)
+                        found_distances.append(distances)
+                    for max_dist in max_dists:
+                        rows.append(dict(
+                            backend=name,
+                            **build_settings,
+                            **query_settings,
+                            k=k,
+                            max_dist=max_dist,
+                            recall=get_recall(found_keys, truth_keys[:, :k]),
+                            match_recall=get_match_recall(found_keys, found_distances, truth_keys[:, :k], truth_distances[:, :k], max_dist),
+                            p50_ms=float(np.percentile(latencies, 50) * 1000),
+                            p99_ms=float(np.percentile(latencies, 99) * 1000),
+                            build_s=build_time,
+                            index_mb=index_bytes / 2 ** 20
+                        ))
+            del backend
+            shutil.rmtree(directory, ignore_errors=True)
+    mark_pareto_front(rows)
+    return rows
+
+
+def get_recall(found_keys, truth_keys):
+    """
+    The mean fraction of the exact k nearest neighbors that were found
+    """
+    return float(np.mean([len(set(found) & set(truth[truth >= 0].tolist())) / max(1, (truth >= 0).sum()) for found, truth in zip(found_keys, truth_keys)]))
+
+
+def get_match_recall(found_keys, found_distances, truth_keys, truth_distances, max_dist):
+    """
+    The fraction of the exact neighbors within max_dist that were found within max_dist,
+    which is what decides whether a sentence gets flagged
+    """
+    n_found, n_truth = 0, 0
+    for found, distances, truth, truth_dist in zip(found_keys, found_distances, truth_keys, truth_distances):
+        expected = set(truth[truth_dist <= max_dist].tolist())
+        n_found += len(expected & set(key for key, distance in zip(found, distances) if distance <= max_dist))
+        n_truth += len(expected)
+    return n_found / n_truth if n_truth else 1.0
+
+
+def mark_pareto_front(rows):
+    """
+    Marks the rows no other row with the same k and max_dist beats on both recall and p99 latency
+    """
+    for row in rows:
+        row["pareto"] = not any(
+            other["k"] == row["k"] and other["max_dist"] == row["max_dist"]
+            and other["recall"] >= row["recall"] and other["p99_ms"] <= row["p99_ms"]
+            and (other["recall"] > row["recall"] or other["p99_ms"] < row["p99_ms"])
+            for other in rows
+        )
+
+
+def format_table(rows):
+    """
+    Lines up the rows in columns
+    """
+    columns = []
+    for row in rows:
+        columns += [column for column in row if column not in columns]
+    format_value = lambda value: "{:.4f}".format(value) if isinstance(value, float) else str(value)
+    widths = [max([len(column)] + [len(format_value(row.get(column, ""))) for row in rows]) + 2 for column in columns]
+    lines = ["".join(column.ljust(width) for column, width in zip(columns, widths))]
+    for row in rows:
+        lines.append("".join(format_value(row.get(column, "")).ljust(width) for column, width in zip(columns, widths)))
+    return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    # Run from the server directory:
+    #   python -m app.database.benchmark database|synthetic:N [setting=value,value ...]
+    # e.g.
+    #   python -m app.database.benchmark synthetic:50000 backend=annoy,ivf n_trees=10,50,100 search_k=1000,7500 n_probe=4,16 k=10 max_dist=5,7
+    # backend, k, max_dist and queries are handled here, every other setting is passed to the
+    # backends that take it as a constructor argument
+    import sys
+
+    settings = {}
+    for arg in sys.argv[2:]:
+        key, values = arg.split("=", 1)
+        settings[key] = []
+        for value in values.split(","):
+            try:
+                settings[key].append(json.loads(value))
+            except ValueError:
+                settings[key].append(value)
+    rows = run(
+        sys.argv[1],
+        names=settings.pop("backend", None),
+        ks=settings.pop("k", None),
+        max_dists=settings.pop("max_dist", None),
+        n_queries=settings.pop("queries", [200])[0],
+        settings=settings
+    )
+    print(format_table(rows))
+    print("\nPareto front (recall against p99 latency):")
+    print(format_table([row for row in rows if row["pareto"]]))
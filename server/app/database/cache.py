@@ -0,0 +1,130 @@
+import sqlite3
+import hashlib
+import json
+import re
+import threading
+import unicodedata
+from collections import OrderedDict
+from app import config
+
+
+def normalize_text(text):
+    """
+    Normalizes text so that copies differing only in unicode form or whitespace share a key
+    """
+    return re.sub(r"\s+", " ", unicodedata.normalize("NFC", text)).strip()
+
+
+def text_digest(text):
+    """
+    Hashes the normalized text
+    """
+    return hashlib.sha256(normalize_text(text).encode("utf-8")).hexdigest()
+
+
+class VerdictCache():
+    """
+    LRU cache of the verdicts for pieces of text, keyed by a hash of the
+    normalized text and the version of the index that produced them.
+    Optionally backed by a SQLite table so that verdicts survive restarts
+    """
+
+    def __init__(self, max_size=10000, path=None):
+        """
+        max_size: the number of verdicts kept in memory
+        path: the SQLite file for the persistent tier, or None to keep everything in memory
+        """
+        self.max_size = max_size
+        self.version = None
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits, self.misses = 0, 0
+        self.conn = None
+        if path:
+            self.conn = sqlite3.connect(path, check_same_thread=False)
+            self.conn.execute("CREATE TABLE IF NOT EXISTS verdicts(key text primary key, version text, verdict text)")
+            self.conn.commit()
+
+    def key(self, digest):
+        """
+        Hashes the digest of a piece of text together with the index version
+        """
+        return hashlib.sha256("{}\0{}".format(self.version, digest).encode("utf-8")).hexdigest()
+
+    def get(self, text):
+        """
+        Returns the cached verdict for the text, or None if there is none
+        """
+        return self.get_digest(text_digest(text))
+
+    def put(self, text, verdict):
+        """
+        Stores the verdict for the text. Verdicts have to be JSON serializable
+        """
+        self.put_digest(text_digest(text), verdict)
+
+    def get_digest(self, digest):
+        """
+        Returns the cached verdict for the text with the given digest, or None if there is none
+        """
+        key = self.key(digest)
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return self.entries[key]
+            verdict = None
+            if self.conn:
+                row = self.conn.execute("SELECT verdict FROM verdicts WHERE key=?", (key,)).fetchone()
+                if row:
+                    verdict = json.loads(row[0])
+                    self._remember(key, verdict)
+            if verdict is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return verdict
+
+    def put_digest(self, digest, verdict):
+        """
+        Stores the verdict for the text with the given digest
+        """
+        key = self.key(digest)
+        with self.lock:
+            self._remember(key, verdict)
+            if self.conn:
+                self.conn.execute("INSERT OR REPLACE INTO verdicts (key, version, verdict) VALUES (?,?,?)", (key, self.version, json.dumps(verdict)))
+                self.conn.commit()
+
+    def set_version(self, version):
+        """
+        Switches to a new index version, dropping every verdict made with another one
+        """
+        with self.lock:
+            if version == self.version:
+                return
+            self.version = version
+            self.entries.clear()
+            if self.conn:
+                self.conn.execute("DELETE FROM verdicts WHERE version != ?", (version,))
+                self.conn.commit()
+
+    def clear(self):
+        """
+        Drops every cached verdict
+        """
+        with self.lock:
+            self.entries.clear()
+            if self.conn:
+                self.conn.execute("DELETE FROM verdicts")
+                self.conn.commit()
+
+    def _remember(self, key, verdict):
+        # Store in memory and evict the least recently used verdicts
+        self.entries[key] = verdict
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+
+verdict_cache = VerdictCache(config["verdict_cache_size"], config["verdict_cache_path"])
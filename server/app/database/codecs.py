@@ -0,0 +1,279 @@
+import numpy as np
+from app import config
+
+
+class Float32Codec():
+    """
+    Stores the vectors as they are
+    """
+
+    # Whether distances on the codes are exact, so reranking would not change anything
+    exact = True
+
+    def __init__(self, dim):
+        self.dim = dim
+
+    def train(self, vectors):
+        pass
+
+    def encode(self, vectors, chunk_size=10000):
+        """
+        Encodes an (N, dim) array of vectors
+        """
+        return np.asarray(vectors, dtype=np.float32)
+
+    def decode(self, codes):
+        return np.asarray(codes, dtype=np.float32)
+
+    def dot(self, codes, vector):
+        """
+        Returns the dot products of the decoded codes with the vector,
+        or with every column of a (dim, N) matrix of vectors
+        """
+        return self.decode(codes).dot(vector)
+
+    def norms(self, codes):
+        """
+        Returns the squared lengths of the decoded codes, or None if distances does not need them
+        """
+        return squared_norms(codes, self.decode)
+
+    def distances(self, codes, norms, vector, chunk_size=10000):
+        """
+        Returns the squared euclidean distances between the decoded codes and the vector
+        """
+        # |x - v|^2 = |x|^2 - 2 x.v + |v|^2
+        distances = np.empty(len(codes), dtype=np.float32)
+        for i in range(0, len(codes), chunk_size):
+            distances[i:i + chunk_size] = norms[i:i + chunk_size] - 2 * self.dot(codes[i:i + chunk_size], vector)
+        return distances + vector.dot(vector)
+
+    def distances_batch(self, codes, norms, vectors):
+        """
+        Returns the (len(vectors), len(codes)) squared euclidean distances between every vector and every decoded code
+        """
+        return norms[None, :] - 2 * self.dot(codes, vectors.T).T + np.einsum("ij,ij->i", vectors, vectors)[:, None]
+
+    def get_params(self):
+        """
+        Returns the trained parameters as a dict of arrays
+        """
+        return {}
+
+    def set_params(self, params):
+        pass
+
+
+class Float16Codec(Float32Codec):
+    """
+    Half precision floats, half the size
+    """
+
+    exact = False
+
+    def encode(self, vectors, chunk_size=10000):
+        return np.concatenate([np.zeros((0, self.dim), dtype=np.float16)] + [np.asarray(vectors[i:i + chunk_size], dtype=np.float16) for i in range(0, len(vectors), chunk_size)])
+
+
+class Int8Codec(Float32Codec):
+    """
+    Scalar quantization: every dimension is mapped from its range onto 256 levels, a quarter of the size
+    """
+
+    exact = False
+
+    def __init__(self, dim):
+        self.dim = dim
+        self.low = np.zeros(dim, dtype=np.float32)
+        self.scale = np.ones(dim, dtype=np.float32)
+
+    def train(self, vectors):
+        self.low = vectors.min(axis=0)
+        self.scale = np.maximum(vectors.max(axis=0) - self.low, 1e-12) / 255
+
+    def encode(self, vectors, chunk_size=10000):
+        codes = np.zeros((len(vectors), self.dim), dtype=np.uint8)
+        for i in range(0, len(vectors), chunk_size):
+            codes[i:i + chunk_size] = np.clip(np.rint((vectors[i:i + chunk_size] - self.low) / self.scale), 0, 255)
+        return codes
+
+    def decode(self, codes):
+        return codes * self.scale + self.low
+
+    def dot(self, codes, vector):
+        # (c * scale + low).v = c.(scale * v) + low.v, so the codes never have to be decoded
+        return codes.astype(np.float32).dot((vector.T * self.scale).T) + self.low.dot(vector)
+
+    def get_params(self):
+        return {"low": self.low, "scale": self.scale}
+
+    def set_params(self, params):
+        self.low, self.scale = params["low"], params["scale"]
+
+
+class PQCodec(Float32Codec):
+    """
+    Product quantization: the vector is cut into pq_subspaces pieces and every piece is
+    replaced by the index of the nearest of 256 centroids, one byte per piece.
+    Distances are computed asymmetrically, the query stays in float32 and is compared
+    with the centroids through a lookup table
+    """
+
+    exact = False
+
+    def __init__(self, dim, subspaces=None, iterations=10):
+        self.dim = dim
+        self.subspaces = subspaces if subspaces is not None else config["pq_subspaces"]
+        if dim % self.subspaces:
+            raise ValueError("pq_subspaces has to divide vector_dim {}".format(dim))
+        self.iterations = iterations
+        # (subspaces, 256, dim / subspaces)
+        self.centroids = np.zeros((self.subspaces, 256, dim // self.subspaces), dtype=np.float32)
+
+    def split(self, vectors):
+        """
+        Returns the (subspaces, N, dim / subspaces) pieces of the vectors
+        """
+        return np.asarray(vectors, dtype=np.float32).reshape(len(vectors), self.subspaces, -1).transpose(1, 0, 2)
+
+    def train(self, vectors):
+        rng = np.random.RandomState(0)
+        k = min(256, len(vectors))
+        self.centroids = np.zeros((self.subspaces, 256, self.dim // self.subspaces), dtype=np.float32)
+        for s, piece in enumerate(self.split(vectors)):
+            self.centroids[s, :k] = kmeans(np.ascontiguousarray(piece), k, self.iterations, rng)
+        # With fewer than 256 training vectors the rest repeat the first centroid, which argmin always picks first
+        self.centroids[:, k:] = self.centroids[:, :1]
+
+    def encode(self, vectors, chunk_size=10000):
+        codes = np.zeros((len(vectors), self.subspaces), dtype=np.uint8)
+        for i in range(0, len(vectors), chunk_size):
+            for s, piece in enumerate(self.split(vectors[i:i + chunk_size])):
+                codes[i:i + chunk_size, s] = assign(piece, self.centroids[s])
+        return codes
+
+    def decode(self, codes):
+        return self.centroids[np.arange(self.subspaces), codes].reshape(len(codes), self.dim)
+
+    def norms(self, codes):
+        return None
+
+    def distances(self, codes, norms, vector, chunk_size=10000):
+        # Distance of every piece of the query to every centroid of its subspace
+        pieces = vector.reshape(self.subspaces, 1, -1)
+        table = np.sum((self.centroids - pieces) ** 2, axis=2)
+        distances = np.empty(len(codes), dtype=np.float32)
+        for i in range(0, len(codes), chunk_size):
+            distances[i:i + chunk_size] = table[np.arange(self.subspaces), codes[i:i + chunk_size]].sum(axis=1)
+        return distances
+
+    def distances_batch(self, codes, norms, vectors):
+        # Every vector needs its own lookup table
+        return np.stack([self.distances(codes, norms, vector) for vector in vectors]) if len(vectors) else np.zeros((0, len(codes)), dtype=np.float32)
+
+    def get_params(self):
+        return {"centroids": self.centroids}
+
+    def set_params(self, params):
+        self.centroids = params["centroids"]
+        self.subspaces = len(self.centroids)
+
+
+codecs = {
+    "float32": Float32Codec,
+    "float16": Float16Codec,
+    "int8": Int8Codec,
+    "pq": PQCodec
+}
+
+
+def create_codec(name, dim):
+    if name not in codecs:
+        raise ValueError("Unknown ann encoding {}, pick one of {}".format(name, ", ".join(codecs)))
+    return codecs[name](dim)
+
+
+def squared_norms(vectors, decode=None, chunk_size=10000):
+    """
+    Returns the squared length of every row, a chunk at a time so memory mapped rows are streamed
+    """
+    norms = np.empty(len(vectors), dtype=np.float32)
+    for i in range(0, len(vectors), chunk_size):
+        chunk = vectors[i:i + chunk_size]
+        chunk = decode(chunk) if decode else np.asarray(chunk, dtype=np.float32)
+        norms[i:i + chunk_size] = np.einsum("ij,ij->i", chunk, chunk)
+    return norms
+
+
+def assign(vectors, centroids):
+    """
+    Returns the index of the nearest centroid of every vector
+    """
+    return np.argmin(squared_norms(centroids)[None, :] - 2 * vectors.dot(centroids.T), axis=1)
+
+
+def kmeans(vectors, k, iterations, rng):
+    """
+    Plain Lloyd's k-means. Clusters that end up empty are restarted on a random vector
+    """
+    centroids = vectors[rng.choice(len(vectors), k, replace=False)].copy()
+    for _ in range(iterations):
+        lists = assign(vectors, centroids)
+        counts = np.bincount(lists, minlength=k)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, lists, vectors)
+        empty = counts == 0
+        centroids[~empty] = sums[~empty] / counts[~empty, None]
+        centroids[empty] = vectors[rng.choice(len(vectors), empty.sum())]
+    return centroids
+
+
+def report(k=10, n_queries=200, rerank_k=None):
+    """
+    Compares every encoding with float32 on the vectors in the store. Queries are vectors
+    from the store, and the query itself is left out of the neighbors
+    Returns one row per encoding with the size of the codes and the recall@k with and without reranking
+    """
+    from app.database.database import open_database
+    from app.database.vectors import sync_vector_store, load_vector_matrix
+    from app.database.ann import ExactBackend
+    open_database()
+    sync_vector_store()
+    keys, vectors = load_vector_matrix()
+    rng = np.random.RandomState(0)
+    queries = np.sort(rng.choice(len(keys), min(n_queries, len(keys)), replace=False))
+
+    def neighbors(backend, i):
+        found = backend.query(vectors[i], k + 1)[0]
+        return set([key for key in found if key != keys[i]][:k])
+
+    rows = []
+    truth = None
+    for name in codecs:
+        backend = ExactBackend(config["vector_dim"], encoding=name, rerank_k=0)
+        backend.build(keys, vectors)
+        if truth is None:
+            truth = [neighbors(backend, i) for i in queries]
+        row = {
+            "encoding": name,
+            "bytes_per_vector": backend.codes.nbytes // max(len(keys), 1),
+            "index_mb": (backend.codes.nbytes + sum(p.nbytes for p in backend.codec.get_params().values())) / 2 ** 20
+        }
+        row["saved"] = 1 - row["bytes_per_vector"] / (config["vector_dim"] * 4)
+        row["recall@{}".format(k)] = np.mean([len(neighbors(backend, i) & t) / max(len(t), 1) for i, t in zip(queries, truth)])
+        backend.rerank_k = rerank_k if rerank_k is not None else config["rerank_k"]
+        row["reranked"] = np.mean([len(neighbors(backend, i) & t) / max(len(t), 1) for i, t in zip(queries, truth)])
+        rows.append(row)
+    return rows
+
+
+if __name__ == "__main__":
+    # Run from the server directory:
+    #   python -m app.database.codecs report [k] [n_queries]
+    import sys
+
+    if sys.argv[1] == "report":
+        rows = report(*[int(arg) for arg in sys.argv[2:4]])
+        print("".join("{:<18}".format(name) for name in rows[0]))
+        for row in rows:
+            print("".join("{:<18.4f}".format(value) if isinstance(value, float) else "{:<18}".format(value) for value in row.values()))
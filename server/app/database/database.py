@@ -2,20 +2,30 @@ import sqlite3
 import numpy as np
 import os
 import io
+import logging
+import threading
+from app.database.artifacts import get_model_hash
 
 c, conn = None, None
+# Sorted (start, end, id) arrays of the claims, for mapping vector ids to claims without a query
+claim_intervals = None
+intervals_lock = threading.Lock()
+# Writes share one connection, so they take turns
+write_lock = threading.Lock()
+
+NPY_MAGIC = b"\x93NUMPY"
 
 # Adapters
+# Vectors are stored as raw little endian float32, rows written by older versions are npy files
 def adapt_array(array):
-    out = io.BytesIO()
-    np.save(out, array)
-    out.seek(0)
-    return sqlite3.Binary(out.read())
+    return sqlite3.Binary(np.ascontiguousarray(array, dtype="<f4").tobytes())
 
 def convert_array(text):
-    out = io.BytesIO(text)
-    out.seek(0)
-    return np.load(out)
+    if text[:len(NPY_MAGIC)] == NPY_MAGIC:
+        out = io.BytesIO(text)
+        out.seek(0)
+        return np.load(out)
+    return np.frombuffer(text, dtype="<f4")
 
 sqlite3.register_adapter(np.ndarray, adapt_array)
 sqlite3.register_converter("array", convert_array)
@@ -29,33 +39,208 @@ def open_database():
     c = conn.cursor()
     c.execute("CREATE TABLE IF NOT EXISTS misinformationData(id integer primary key autoincrement, sentence text, link text, info text, start integer, end integer)")
     c.execute("CREATE TABLE IF NOT EXISTS vectorTable(id integer primary key autoincrement, vector array)")
+    c.execute("CREATE INDEX IF NOT EXISTS misinformationStart ON misinformationData(start)")
+    # Holds encoder_hash, the model every vector in vectorTable was encoded with
+    c.execute("CREATE TABLE IF NOT EXISTS meta(key text primary key, value text)")
 
 def close_database():
     c.close()
     conn.close()
 
 def insert_sentence_object(sentence, link, info, vectors):
-    start = insert_vector(vectors[0])
-    end = start
-    for i in range(1, len(vectors)):
-        end = insert_vector(vectors[i])
-    c.execute("INSERT INTO misinformationData (sentence, link, info, start, end) VALUES (?,?,?,?,?)", (sentence, link, info, start, end))
-    conn.commit()
+    return insert_sentence_objects([(sentence, link, info, vectors)])[0]
+
+def insert_sentence_objects(rows):
+    """
+    Adds many claims and their vectors in a single transaction
+    rows: list of (sentence, link, info, vectors)
+    Returns the (start, end) range of vector ids given to each claim
+    """
+    with write_lock:
+        cursor = conn.cursor()
+        try:
+            # Take the database's write lock before reading the ids, so no other thread or process can hand out the same ones
+            cursor.execute("BEGIN IMMEDIATE")
+            # Hand out the vector ids ourselves so that every claim gets a contiguous range
+            cursor.execute("SELECT MAX(id) FROM vectorTable")
+            max_id = cursor.fetchone()[0] or 0
+            cursor.execute("SELECT seq FROM sqlite_sequence WHERE name='vectorTable'")
+            seq = cursor.fetchone()
+            next_id = max(max_id, seq[0] if seq else 0) + 1
+            record_encoder_hash(cursor)
+            vector_rows, claim_rows = [], []
+            for sentence, link, info, vectors in rows:
+                start = next_id
+                for vector in vectors:
+                    vector_rows.append((next_id, vector))
+                    next_id += 1
+                claim_rows.append((sentence, link, info, start, next_id - 1))
+            cursor.executemany("INSERT INTO vectorTable (id, vector) VALUES (?,?)", vector_rows)
+            cursor.executemany("INSERT INTO misinformationData (sentence, link, info, start, end) VALUES (?,?,?,?,?)", claim_rows)
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+        finally:
+            cursor.close()
+    reset_claim_intervals()
+    return [(start, end) for _, _, _, start, end in claim_rows]
 
 def insert_vector(vector):
     """
     Adds a vector to the vector table
     """
-    c.execute("INSERT INTO vectorTable (vector) VALUES (?)", (vector,))
-    conn.commit()
-    return c.lastrowid
+    with write_lock:
+        try:
+            record_encoder_hash(conn)
+            cursor = conn.execute("INSERT INTO vectorTable (vector) VALUES (?)", (vector,))
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+        return cursor.lastrowid
+
+def get_encoder_hash():
+    """
+    Returns the hash of the model the vectors in vectorTable were encoded with, or None if none were added yet
+    """
+    row = conn.execute("SELECT value FROM meta WHERE key='encoder_hash'").fetchone()
+    return row[0] if row else None
+
+def record_encoder_hash(cursor):
+    """
+    Records the model in use as the one the vectors are encoded with, if there are none yet,
+    inside the caller's write transaction
+    Raises RuntimeError if the vectors were encoded with a different model, they would not be comparable
+    """
+    row = cursor.execute("SELECT value FROM meta WHERE key='encoder_hash'").fetchone()
+    if row is None:
+        cursor.execute("INSERT INTO meta (key, value) VALUES ('encoder_hash', ?)", (get_model_hash(),))
+    elif row[0] != get_model_hash():
+        raise RuntimeError("The vectors in the database were encoded with model {}, app/models holds {}. Re-encode the claims before adding more".format(row[0], get_model_hash()))
+
+def check_encoder_hash():
+    """
+    Checks at startup that the vectors were encoded with the model in app/models
+    Databases from before the hash was recorded are assumed to match and get it recorded
+    Raises RuntimeError if they do not match, searching would compare vectors of two different models
+    """
+    stored = get_encoder_hash()
+    if stored is None:
+        if conn.execute("SELECT 1 FROM vectorTable LIMIT 1").fetchone() is not None:
+            logging.warning("No encoder hash recorded for the vectors in the database, assuming they were encoded with the model in app/models")
+        with write_lock:
+            try:
+                record_encoder_hash(conn)
+                conn.commit()
+            except BaseException:
+                conn.rollback()
+                raise
+    elif stored != get_model_hash():
+        raise RuntimeError("The vectors in the database were encoded with model {}, app/models holds {}. Re-encode the claims, or put the old model back".format(stored, get_model_hash()))
 
 def get_all_keys_and_vectors():
-    return [pair for pair in c.execute("SELECT id, vector FROM vectorTable")]
+    return conn.execute("SELECT id, vector FROM vectorTable").fetchall()
 
 def get_return_from_keys(keys):
-    out = set()
-    for key in keys:
-        c.execute(f"SELECT sentence, link, info FROM misinformationData WHERE start <= ? AND end >= ?", (key,key))
-        out.add(c.fetchone())
-    return tuple(out)
\ No newline at end of file
+    """
+    Returns the (sentence, link, info) of the claims the vector ids belong to, in one query
+    """
+    return tuple(set(get_claims(get_claim_ids(keys)).values()))
+
+def get_claims(claim_ids):
+    """
+    Returns a dict from claim id to the claim's (sentence, link, info), in one query
+    """
+    claim_ids = sorted(set(int(claim_id) for claim_id in claim_ids))
+    out = {}
+    # Stay under SQLite's limit on the number of parameters
+    for i in range(0, len(claim_ids), 900):
+        chunk = claim_ids[i:i + 900]
+        # A cursor per call, the shared one cannot be used by several threads at once
+        for row in conn.execute("SELECT id, sentence, link, info FROM misinformationData WHERE id IN ({})".format(",".join("?" * len(chunk))), chunk).fetchall():
+            out[row[0]] = row[1:]
+    return out
+
+def get_claim_ids(keys):
+    """
+    Maps vector ids to the ids of the claims whose start..end range contains them
+    Vector ids that do not belong to any claim are left out
+    """
+    claim_ids = map_keys_to_claims(list(keys))
+    return claim_ids[claim_ids >= 0].tolist()
+
+def map_keys_to_claims(keys):
+    """
+    Maps an array of vector ids, of any shape, to an array of claim ids of the same shape
+    Vector ids that do not belong to any claim map to -1
+    """
+    starts, ends, ids = get_claim_intervals()
+    keys = np.asarray(keys, dtype=np.int64)
+    claim_ids = np.full(keys.shape, -1, dtype=np.int64)
+    if keys.size == 0 or len(starts) == 0:
+        return claim_ids
+    # Binary search for the last claim starting at or before each key
+    positions = np.searchsorted(starts, keys, side="right") - 1
+    found = positions >= 0
+    found[found] = ends[positions[found]] >= keys[found]
+    claim_ids[found] = ids[positions[found]]
+    return claim_ids
+
+def get_claim_intervals():
+    """
+    Returns the claims' starts, ends and ids sorted by start, loading them on first use
+    """
+    global claim_intervals
+    with intervals_lock:
+        if claim_intervals is None:
+            rows = conn.execute("SELECT start, end, id FROM misinformationData ORDER BY start").fetchall()
+            claim_intervals = tuple(np.array([row[i] for row in rows], dtype=np.int64) for i in range(3))
+        return claim_intervals
+
+def reset_claim_intervals():
+    """
+    Forces the claim intervals to be reloaded, e.g. after claims were added
+    """
+    global claim_intervals
+    with intervals_lock:
+        claim_intervals = None
+
+def get_all_claims():
+    """
+    Returns the id and text of every claim in the misinformation table
+    """
+    return conn.execute("SELECT id, sentence FROM misinformationData").fetchall()
+
+
+def get_claims_version():
+    """
+    Identifies the set of claims, changes when claims are added or removed
+    """
+    return tuple(conn.execute("SELECT COUNT(*), MAX(id) FROM misinformationData").fetchone())
+
+
+def migrate_vector_blobs(batch_size=1000):
+    """
+    Rewrites the vectors stored as npy files as raw float32, then shrinks the database file
+    Returns the number of rows that were rewritten
+    """
+    migrated = 0
+    while True:
+        rows = c.execute("SELECT id, vector FROM vectorTable WHERE substr(vector, 1, ?) = ? LIMIT ?", (len(NPY_MAGIC), NPY_MAGIC, batch_size)).fetchall()
+        if not rows:
+            break
+        with conn:
+            c.executemany("UPDATE vectorTable SET vector=? WHERE id=?", [(vector, key) for key, vector in rows])
+        migrated += len(rows)
+    conn.execute("VACUUM")
+    return migrated
+
+
+if __name__ == "__main__":
+    # Run from the server directory: python -m app.database.database migrate
+    import sys
+
+    if sys.argv[1:] == ["migrate"]:
+        open_database()
+        print("Migrated {} vectors".format(migrate_vector_blobs()))
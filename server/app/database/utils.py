@@ -1,9 +1,27 @@
 from app.database.database import *
+from app.database import database, artifacts
+from app.database.cache import verdict_cache
+from app.database.vectors import sync_vector_store, load_vector_matrix
+from app.database.ann import create_backend, nearest_rows
+from app.database.codecs import squared_norms
 import os
+import json
+import logging
+import hashlib
+import threading
+import numpy as np
 from app import config
-from annoy import AnnoyIndex
 
+# "trees" is whichever ann backend the config picks, see app/database/ann.py
 trees = None
+# The artifact directory the trees were loaded from, see app/database/artifacts.py
+trees_path = None
+# Vectors added since the trees were built, searched exactly until the next rebuild
+delta = (np.zeros(0, dtype=np.int64), np.zeros((0, config["vector_dim"]), dtype=np.float32))
+index_lock = threading.Lock()
+rebuild_lock = threading.Lock()
+rebuild_thread = None
+rebuild_again = False
 
 def load_structures():
     """
@@ -11,48 +29,231 @@ def load_structures():
     """
     # Open database and/or load dict
     open_database()
-    # Load trees
-    if os.path.isfile(os.path.join("app", "database", "trees.ann")):
-        load_trees_from_file()
-    else:
+    # Refuse to search vectors of a different encoder model, rebuilding from them would not help
+    database.check_encoder_hash()
+    # Load trees, unless they do not match the database or the settings
+    if not load_trees_from_file():
         construct_trees_from_database()
 
 
+def ensure_structures():
+    """
+    Loads the database and the binary trees if they are not loaded yet,
+    and picks up trees another process built since
+    """
+    if trees is None:
+        load_structures()
+    elif artifacts.get_current_artifact() not in (None, trees_path):
+        load_trees_from_file()
+
+
 def construct_trees_from_database():
-    global trees
-    # Creates a new index
-    trees = AnnoyIndex(config["vector_dim"], "euclidean")
-    for key, vector in get_all_keys_and_vectors():
-        trees.add_item(key, vector)
-    trees.build(config["n_trees"])
-    trees.save( os.path.join("app", "database", "trees.ann") )
+    """
+    Rebuilds the trees from scratch and waits for them
+    """
+    swap_trees(*build_trees())
+    # Verdicts made with the old index are no longer valid
+    verdict_cache.clear()
+
+
+def build_trees():
+    """
+    Builds trees from the vector store and saves them to a new artifact directory, leaving the trees in use alone
+    Returns the new trees and their directory
+    Only one process builds at a time. If another one published trees that already hold every
+    vector while we waited, those are used instead of building the same thing again
+    """
+    with artifacts.build_lock():
+        path = artifacts.get_current_artifact()
+        if path is not None and path != trees_path:
+            manifest, problem = artifacts.check_artifact(path, database.conn, database.get_encoder_hash())
+            max_id = database.conn.execute("SELECT MAX(id) FROM vectorTable").fetchone()[0] or 0
+            if problem is None and manifest["max_row_id"] >= max_id:
+                new_trees = create_backend()
+                new_trees.load(artifacts.get_index_path(path))
+                return new_trees, path
+        # Creates a new index
+        new_trees = create_backend()
+        # Read the vectors straight from the memory mapped store
+        sync_vector_store()
+        keys, vectors = load_vector_matrix()
+        new_trees.build(keys, vectors)
+        directory = artifacts.new_artifact()
+        # Saving also memory maps the files back in, read only
+        new_trees.save(artifacts.get_index_path(directory))
+        return new_trees, artifacts.publish_artifact(directory, new_trees, keys, database.get_encoder_hash())
+
+
+def swap_trees(new_trees, path):
+    """
+    Puts newly built trees in use, see use_trees, and removes old artifacts
+    """
+    use_trees(new_trees, path)
+    artifacts.prune_artifacts()
+    # Claims may have been added by another process
+    reset_claim_intervals()
+    verdict_cache.set_version(get_index_version())
+
+
+def use_trees(new_trees, path):
+    """
+    Puts trees in use in one step, so searches see either the old trees or the new ones
+    """
+    global trees, trees_path, delta
+    with index_lock:
+        trees, trees_path = new_trees, path
+        # The vectors that made it into the trees no longer need an exact search
+        keys, vectors = delta
+        keep = keys >= new_trees.get_n_items()
+        delta = (keys[keep], vectors[keep])
+
+
+def schedule_rebuild():
+    """
+    Rebuilds the trees in a background thread. If a rebuild is already running, another one follows it
+    """
+    global rebuild_thread, rebuild_again
+    with rebuild_lock:
+        if rebuild_thread is not None:
+            rebuild_again = True
+            return
+        rebuild_thread = threading.Thread(target=rebuild_in_background, daemon=True)
+        rebuild_thread.start()
+
+
+def rebuild_in_background():
+    global rebuild_thread, rebuild_again
+    try:
+        while True:
+            try:
+                swap_trees(*build_trees())
+            except Exception:
+                # Keep searching the old trees and the delta buffer, the next schedule_rebuild tries again
+                logging.exception("Could not rebuild the index")
+            with rebuild_lock:
+                if not rebuild_again:
+                    rebuild_thread = None
+                    return
+                rebuild_again = False
+    finally:
+        # Whatever happens, leave the slot free so later rebuilds can start
+        with rebuild_lock:
+            if rebuild_thread is threading.current_thread():
+                rebuild_thread = None
+
+
+def add_vectors_to_index(keys, vectors):
+    """
+    Makes newly inserted vectors searchable right away by adding them to the exact search buffer
+    """
+    global delta
+    with index_lock:
+        delta = (
+            np.concatenate([delta[0], np.asarray(keys, dtype=np.int64)]),
+            np.concatenate([delta[1], np.asarray(vectors, dtype=np.float32).reshape(-1, config["vector_dim"])])
+        )
+    verdict_cache.set_version(get_index_version())
 
 
 def load_trees_from_file():
-    # loads trees from file
-    global trees
-    trees = AnnoyIndex(config["vector_dim"], "euclidean")
-    trees.load( os.path.join("app", "database", "trees.ann") )
+    """
+    Memory maps the trees in the current artifact directory, after checking its manifest
+    Returns False if there are no trees, or they are stale or do not match the settings and have to be rebuilt
+    """
+    path = artifacts.get_current_artifact()
+    if path is None:
+        return False
+    manifest, problem = artifacts.check_artifact(path, database.conn, database.get_encoder_hash())
+    new_trees = create_backend()
+    if problem is None:
+        new_trees.load(artifacts.get_index_path(path))
+        # The ids in the index have to be the ones the manifest says it was built from
+        if manifest["vector_count"] and new_trees.get_n_items() != manifest["max_row_id"] + 1:
+            problem = "the index holds ids up to {}, the manifest says {}".format(new_trees.get_n_items() - 1, manifest["max_row_id"])
+    if problem is not None:
+        logging.warning("Not using the index in %s: %s", path, problem)
+        return False
+    use_trees(new_trees, path)
+    # Vectors added after the build are searched exactly until the rebuild is done
+    rows = database.conn.execute("SELECT id, vector FROM vectorTable WHERE id > ? ORDER BY id", (manifest["max_row_id"],)).fetchall()
+    with index_lock:
+        buffered = set(delta[0].tolist())
+    rows = [row for row in rows if row[0] not in buffered]
+    if rows:
+        add_vectors_to_index([key for key, _ in rows], np.stack([vector for _, vector in rows]))
+        schedule_rebuild()
+    reset_claim_intervals()
+    verdict_cache.set_version(get_index_version())
+    return True
+
+
+def get_index_version():
+    """
+    Identifies the data and the search settings behind the loaded trees
+    """
+    with index_lock:
+        n_items = max([trees.get_n_items()] + [int(key) + 1 for key in delta[0][-1:]])
+    settings = [n_items] + [config[key] for key in ("ann_backend", "n_trees", "search_k", "ivf_lists", "ivf_probe", "ann_encoding", "pq_subspaces", "rerank_k", "max_results_per_query", "max_dist", "candidate_gate", "candidate_min_overlap", "lazy_coref", "coref_window", "encoder_backend", "max_seq_length", "max_adverbials_per_proposition", "max_adverbial_combinations", "max_propositions")]
+    return hashlib.sha1(json.dumps(settings).encode("utf-8")).hexdigest()[:16]
 
 
 def get_similar_misinformation(sentence):
     # Wraps the method below so that it runs for multiple vectors within a sentence
-    most_similar = set()
-    for vector in sentence.embeddings:
-        for key in get_most_similar(vector):
-            most_similar.add(key)
-    # Return the keys and their associated data
-    return [{
-        "error": p[0],
-        "source": p[1],
-        "correct": p[2]
-    } for p in get_return_from_keys(most_similar)]
+    return get_similar_misinformation_batch([sentence])[0]
+
+
+def get_similar_misinformation_batch(sentences):
+    """
+    Searches the vectors of many sentences together, and looks up all of their claims in one query
+    Returns the list of matching claims of each sentence, nearest first
+    """
+    # Stack the vectors of every sentence and remember which sentence each row came from
+    vectors = [np.asarray(sentence.embeddings, dtype=np.float32).reshape(-1, config["vector_dim"]) for sentence in sentences]
+    owners = np.repeat(np.arange(len(sentences)), [len(v) for v in vectors])
+    if len(owners) == 0:
+        return [[] for _ in sentences]
+    keys, distances = get_most_similar_batch(np.concatenate(vectors))
+    # Map every key under the distance to its claim and look the claims up at once
+    claim_ids = map_keys_to_claims(np.where(distances <= config["max_dist"], keys, -1))
+    claims = get_claims(claim_ids[claim_ids >= 0])
+    # Hand the claims back to their sentences, nearest first and without repeats
+    out = [[] for _ in sentences]
+    seen = [set() for _ in sentences]
+    order = np.argsort(distances, axis=None, kind="stable")
+    for row, column in zip(*np.unravel_index(order, distances.shape)):
+        claim = claims.get(int(claim_ids[row, column]))
+        owner = owners[row]
+        if claim is not None and claim not in seen[owner]:
+            seen[owner].add(claim)
+            out[owner].append({
+                "error": claim[0],
+                "source": claim[1],
+                "correct": claim[2]
+            })
+    return out
 
 
 def get_most_similar(vector):
-    # Search the loaded trees
-    global trees
-    # Search
-    keys, distances = trees.get_nns_by_vector(vector, config["max_results_per_query"], search_k=config["search_k"], include_distances=True)
     # return the keys that are over the distance
-    return [keys[i] for i in range(len(keys)) if distances[i] <= config["max_dist"]]
+    keys, distances = get_most_similar_batch(np.asarray(vector, dtype=np.float32).reshape(1, -1))
+    return keys[0][distances[0] <= config["max_dist"]].tolist()
+
+
+def get_most_similar_batch(vectors):
+    """
+    Searches the nearest max_results_per_query vectors of every row of an (N, vector_dim) matrix
+    Returns (N, max_results_per_query) arrays of keys and distances, padded with -1 and inf
+    """
+    n = config["max_results_per_query"]
+    # Take the trees and the buffer together, so a swap cannot happen in between
+    with index_lock:
+        index, (delta_keys, delta_vectors) = trees, delta
+    # Search
+    keys, distances = index.query_batch(vectors, n)
+    # Search the vectors added since the last build exactly and merge the results
+    if len(delta_keys):
+        delta_distances = np.sqrt(np.maximum(squared_norms(delta_vectors)[None, :] - 2 * vectors.dot(delta_vectors.T) + squared_norms(vectors)[:, None], 0))
+        keys = np.hstack([keys, np.broadcast_to(delta_keys, delta_distances.shape)])
+        distances = np.hstack([distances, delta_distances.astype(np.float32)])
+        keys, distances = nearest_rows(keys, distances, n)
+    return keys, distances
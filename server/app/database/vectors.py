@@ -0,0 +1,123 @@
+import os
+import threading
+import numpy as np
+from app.database import database
+from app import config
+
+VECTORS_PATH = os.path.join("app", "database", "vectors.f32")
+IDS_PATH = os.path.join("app", "database", "vector_ids.i64")
+
+lock = threading.Lock()
+# The maps get_vectors reads from, reopened when the files are replaced
+store_maps = None
+
+
+def sync_vector_store(chunk_size=10000):
+    """
+    Brings the flat vector files up to date with vectorTable by appending the rows they are missing.
+    vectors.f32 holds one float32 row of vector_dim values per vector and vector_ids.i64 holds the
+    matching vectorTable ids, in increasing order
+    Other threads may have the files memory mapped, so they are never changed in place: the new
+    contents are written to temporary files that replace the old ones
+    Returns the number of vectors in the store
+    """
+    with lock:
+        row_bytes = config["vector_dim"] * 4
+        # A half written tail, e.g. after a crash, is left out
+        n = min(_file_size(IDS_PATH) // 8, _file_size(VECTORS_PATH) // row_bytes)
+        last_id = 0
+        if n > 0:
+            last_id = int(np.memmap(IDS_PATH, dtype="<i8", mode="r")[n - 1])
+            # If rows before the last id changed, the store no longer lines up and has to be rebuilt
+            if database.conn.execute("SELECT COUNT(*) FROM vectorTable WHERE id <= ?", (last_id,)).fetchone()[0] != n:
+                n, last_id = 0, 0
+        cursor = database.conn.cursor()
+        cursor.execute("SELECT id, vector FROM vectorTable WHERE id > ? ORDER BY id", (last_id,))
+        rows = cursor.fetchmany(chunk_size)
+        if not rows and _file_size(IDS_PATH) == n * 8 and _file_size(VECTORS_PATH) == n * row_bytes:
+            cursor.close()
+            return n
+        with open(IDS_PATH + ".tmp", "wb") as ids_file, open(VECTORS_PATH + ".tmp", "wb") as vectors_file:
+            _copy_prefix(IDS_PATH, ids_file, n * 8)
+            _copy_prefix(VECTORS_PATH, vectors_file, n * row_bytes)
+            while rows:
+                ids_file.write(np.array([key for key, _ in rows], dtype="<i8").tobytes())
+                vectors_file.write(np.stack([vector for _, vector in rows]).astype("<f4").tobytes())
+                n += len(rows)
+                rows = cursor.fetchmany(chunk_size)
+        cursor.close()
+        # The vectors go first: load_vector_matrix only maps as many rows as both files hold
+        os.replace(VECTORS_PATH + ".tmp", VECTORS_PATH)
+        os.replace(IDS_PATH + ".tmp", IDS_PATH)
+        reset_store_maps()
+        return n
+
+
+def load_vector_matrix():
+    """
+    Memory maps the vector store read only
+    Returns the (N,) array of ids and the (N, vector_dim) matrix of vectors
+    """
+    n = min(_file_size(IDS_PATH) // 8, _file_size(VECTORS_PATH) // (config["vector_dim"] * 4))
+    if n == 0:
+        return np.zeros(0, dtype="<i8"), np.zeros((0, config["vector_dim"]), dtype="<f4")
+    ids = np.memmap(IDS_PATH, dtype="<i8", mode="r", shape=(n,))
+    vectors = np.memmap(VECTORS_PATH, dtype="<f4", mode="r", shape=(n, config["vector_dim"]))
+    return ids, vectors
+
+
+def get_vectors(keys):
+    """
+    Returns the float32 vectors of the given vectorTable ids from the store
+    Raises KeyError if an id is not in the store
+    """
+    global store_maps
+    keys = np.asarray(keys, dtype=np.int64)
+    for attempt in range(2):
+        maps = store_maps
+        if maps is None:
+            maps = store_maps = load_vector_matrix()
+        ids, vectors = maps
+        positions = np.minimum(np.searchsorted(ids, keys), max(len(ids) - 1, 0))
+        found = np.asarray(ids[positions] == keys) if len(ids) else np.zeros(len(keys), dtype=bool)
+        if found.all():
+            return np.asarray(vectors[positions], dtype=np.float32)
+        # Another process may have replaced the files since they were mapped
+        reset_store_maps()
+    raise KeyError("Vector ids not in the store: {}".format(keys[~found].tolist()[:10]))
+
+
+def reset_store_maps():
+    """
+    Makes get_vectors map the files again, e.g. after they were replaced
+    """
+    global store_maps
+    store_maps = None
+
+
+def iter_vector_chunks(chunk_size=10000):
+    """
+    Yields (ids, vectors) slices of the memory mapped store without copying them
+    """
+    ids, vectors = load_vector_matrix()
+    for i in range(0, len(ids), chunk_size):
+        yield ids[i:i + chunk_size], vectors[i:i + chunk_size]
+
+
+def _file_size(path):
+    return os.path.getsize(path) if os.path.isfile(path) else 0
+
+
+def _copy_prefix(path, out, size, chunk_size=2 ** 24):
+    """
+    Copies the first size bytes of the file at path to the open file out
+    """
+    if size == 0:
+        return
+    with open(path, "rb") as f:
+        while size > 0:
+            data = f.read(min(chunk_size, size))
+            if not data:
+                break
+            out.write(data)
+            size -= len(data)
@@ -0,0 +1,89 @@
+import logging
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from app import config
+from app.pipeline import iter_check_articles
+
+jobs = {}
+lock = threading.Lock()
+executor = ThreadPoolExecutor(max_workers=config["job_workers"])
+
+
+class Job():
+    """
+    Class for keeping track of a queued page scan
+    """
+
+    def __init__(self, article_arr):
+        self.id = uuid.uuid4().hex
+        self.article_arr = article_arr
+        self.status = "queued"
+        self.results = []
+        self.error = None
+        self.finished = None
+
+    def to_dict(self):
+        """
+        Returns the state of the job, including the results found so far
+        """
+        with lock:
+            return {
+                "id": self.id,
+                "status": self.status,
+                "results": list(self.results),
+                "error": self.error
+            }
+
+
+def submit_job(article_arr):
+    """
+    Queues a list of texts for fact checking and returns the job id right away
+    """
+    expire_jobs()
+    job = Job(article_arr)
+    with lock:
+        jobs[job.id] = job
+    executor.submit(run_job, job)
+    return job.id
+
+
+def get_job(job_id):
+    """
+    Returns the job with the given id, or None if it does not exist or has expired
+    """
+    expire_jobs()
+    with lock:
+        return jobs.get(job_id)
+
+
+def run_job(job):
+    """
+    Runs the fact checking pipeline for a job, publishing results as they are found
+    """
+    with lock:
+        job.status = "running"
+    try:
+        for record in iter_check_articles(job.article_arr, config["stream_chunk_size"]):
+            with lock:
+                job.results.append(record)
+        status, error = "done", None
+    except Exception as e:
+        logging.exception("Job %s failed", job.id)
+        status, error = "failed", str(e)
+    with lock:
+        job.status = status
+        job.error = error
+        job.finished = time.time()
+        job.article_arr = None
+
+
+def expire_jobs():
+    """
+    Removes the finished jobs that are older than the job TTL
+    """
+    cutoff = time.time() - config["job_ttl"]
+    with lock:
+        for job_id in [job_id for job_id, job in jobs.items() if job.finished and job.finished < cutoff]:
+            del jobs[job_id]
@@ -0,0 +1,250 @@
+import os
+import json
+import threading
+import numpy as np
+from sentence_transformers import SentenceTransformer
+from app import config
+
+MODEL_PATH = os.path.join("app", "models")
+ONNX_PATH = os.path.join(MODEL_PATH, "encoder.onnx")
+INT8_PATH = os.path.join(MODEL_PATH, "encoder_int8.pt")
+
+# Counts of the tokens the encoder was given, to see how much of its work is padding
+padding_stats = {"batches": 0, "sequences": 0, "real_tokens": 0, "padded_tokens": 0}
+stats_lock = threading.Lock()
+
+
+class TorchEncoder():
+    """
+    Reference encoder: the full precision SentenceTransformer in app/models
+    """
+
+    def __init__(self, path=MODEL_PATH):
+        self.model = SentenceTransformer(model_name_or_path=path)
+
+    def encode(self, ids, batch_size=32):
+        """
+        Encodes a list of id lists into a (len(ids), vector_dim) array
+        """
+        return self.model.encode(ids, batch_size=batch_size, is_pretokenized=True, convert_to_numpy=True)
+
+
+class QuantizedTorchEncoder(TorchEncoder):
+    """
+    The SentenceTransformer with its linear layers dynamically quantized to int8
+    """
+
+    def __init__(self, path=MODEL_PATH):
+        import torch
+        if os.path.isfile(INT8_PATH):
+            self.model = torch.load(INT8_PATH)
+        else:
+            self.model = quantize(SentenceTransformer(model_name_or_path=path))
+
+
+class OnnxEncoder():
+    """
+    The SentenceTransformer exported to ONNX and run with onnxruntime
+    """
+
+    def __init__(self, path=ONNX_PATH):
+        try:
+            import onnxruntime
+        except ImportError:
+            raise ImportError("The onnx encoder backend needs onnxruntime, install it with pip install onnxruntime")
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        self.session = onnxruntime.InferenceSession(path, options)
+        self.max_seq_length = get_max_seq_length()
+
+    def encode(self, ids, batch_size=32):
+        """
+        Encodes a list of id lists into a (len(ids), vector_dim) array
+        """
+        embeddings = []
+        for i in range(0, len(ids), batch_size):
+            input_ids, attention_mask = get_features(ids[i:i + batch_size], self.max_seq_length)
+            embeddings.append(self.session.run(None, {"input_ids": input_ids, "attention_mask": attention_mask})[0])
+        if len(embeddings) == 0:
+            return np.zeros((0, config["vector_dim"]), dtype=np.float32)
+        return np.concatenate(embeddings)
+
+
+backends = {
+    "torch": TorchEncoder,
+    "int8": QuantizedTorchEncoder,
+    "onnx": OnnxEncoder
+}
+
+
+def load_encoder(backend=None):
+    """
+    Loads the encoder backend named in the config
+    """
+    if backend is None:
+        backend = config["encoder_backend"]
+    if backend not in backends:
+        raise ValueError("Unknown encoder backend {}, pick one of {}".format(backend, ", ".join(backends)))
+    return backends[backend]()
+
+
+def encode_batched(encoder, ids, batch_size=None, max_tokens=None):
+    """
+    Encodes id lists in batches of similar lengths so that as little padding as possible is needed.
+    A batch holds at most batch_size id lists and at most max_tokens tokens once padded
+    Returns the embeddings in the same order as the ids
+    """
+    if batch_size is None:
+        batch_size = config["encode_batch_size"]
+    if max_tokens is None:
+        max_tokens = config["encode_max_tokens"]
+    embeddings = np.zeros((len(ids), config["vector_dim"]), dtype=np.float32)
+    # Sort by length and cut into batches. A batch is padded to the length of its last id list
+    order = sorted(range(len(ids)), key=lambda i: len(ids[i]))
+    batches, batch = [], []
+    for i in order:
+        if batch and (len(batch) >= batch_size or (len(batch) + 1) * len(ids[i]) > max_tokens):
+            batches.append(batch)
+            batch = []
+        batch.append(i)
+    if batch:
+        batches.append(batch)
+    for batch in batches:
+        embeddings[batch] = encoder.encode([ids[i] for i in batch], batch_size=len(batch))
+        with stats_lock:
+            padding_stats["batches"] += 1
+            padding_stats["sequences"] += len(batch)
+            padding_stats["real_tokens"] += sum(len(ids[i]) for i in batch)
+            padding_stats["padded_tokens"] += len(batch) * len(ids[batch[-1]])
+    return embeddings
+
+
+def get_padding_stats():
+    """
+    Returns the token counts of everything encoded so far and the fraction of real tokens
+    """
+    with stats_lock:
+        stats = dict(padding_stats)
+    stats["efficiency"] = stats["real_tokens"] / stats["padded_tokens"] if stats["padded_tokens"] else 1.0
+    return stats
+
+
+def get_max_seq_length():
+    """
+    Reads the maximum sequence length the SentenceTransformer was saved with
+    """
+    path = os.path.join(MODEL_PATH, "0_Transformer", "sentence_bert_config.json")
+    if os.path.isfile(path):
+        with open(path, "r") as f:
+            return json.load(f).get("max_seq_length", 128)
+    return 128
+
+
+def get_features(ids, max_seq_length):
+    """
+    Pads a batch of id lists the way sentence_transformers does for pretokenized input.
+    It wraps the ids in another start and end token and keeps at most max_seq_length + 1 of them
+    """
+    sequences = [[101] + sentence_ids[:max_seq_length + 1] + [102] for sentence_ids in ids]
+    length = max(len(sequence) for sequence in sequences)
+    input_ids = np.zeros((len(sequences), length), dtype=np.int64)
+    attention_mask = np.zeros((len(sequences), length), dtype=np.int64)
+    for i, sequence in enumerate(sequences):
+        input_ids[i, :len(sequence)] = sequence
+        attention_mask[i, :len(sequence)] = 1
+    return input_ids, attention_mask
+
+
+def quantize(model):
+    """
+    Dynamically quantizes the linear layers of a model to int8
+    """
+    import torch
+    return torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+
+
+def export_int8(path=INT8_PATH):
+    """
+    Saves a dynamically quantized copy of the SentenceTransformer
+    """
+    import torch
+    torch.save(quantize(SentenceTransformer(model_name_or_path=MODEL_PATH)), path)
+
+
+def export_onnx(path=ONNX_PATH):
+    """
+    Exports the SentenceTransformer, pooling included, to ONNX
+    """
+    import torch
+
+    class Wrapper(torch.nn.Module):
+        def __init__(self, model):
+            super().__init__()
+            self.model = model
+
+        def forward(self, input_ids, attention_mask):
+            return self.model({"input_ids": input_ids, "attention_mask": attention_mask})["sentence_embedding"]
+
+    model = Wrapper(SentenceTransformer(model_name_or_path=MODEL_PATH, device="cpu")).eval()
+    input_ids, attention_mask = get_features([[101, 7592, 2088, 102]], get_max_seq_length())
+    with torch.no_grad():
+        torch.onnx.export(
+            model,
+            (torch.from_numpy(input_ids), torch.from_numpy(attention_mask)),
+            path,
+            input_names=["input_ids", "attention_mask"],
+            output_names=["sentence_embedding"],
+            dynamic_axes={"input_ids": {0: "batch", 1: "sequence"}, "attention_mask": {0: "batch", 1: "sequence"}, "sentence_embedding": {0: "batch"}},
+            opset_version=11
+        )
+
+
+def validate(backend, texts, k=10):
+    """
+    Compares a backend against the reference encoder on held out texts.
+    Reports how close the embeddings are and how much the nearest neighbor sets
+    in the loaded index, and the keys that pass max_dist, agree
+    """
+    from app.parsing.parser import split_into_sentences
+    from app.parsing.sentence import Sentence
+    from app.database import utils
+    utils.load_structures()
+    ids = []
+    for text in texts:
+        for sent in split_into_sentences(text):
+            ids += Sentence(sent, encode=False).ids
+    reference = TorchEncoder().encode(ids)
+    candidate = load_encoder(backend).encode(ids)
+    cosine = np.sum(reference * candidate, axis=1) / (np.linalg.norm(reference, axis=1) * np.linalg.norm(candidate, axis=1))
+    distance = np.linalg.norm(reference - candidate, axis=1)
+    overlaps, agreements = [], []
+    for ref, cand in zip(reference, candidate):
+        ref_keys = set(utils.trees.query(ref, k)[0])
+        cand_keys = set(utils.trees.query(cand, k)[0])
+        overlaps.append(len(ref_keys & cand_keys) / max(len(ref_keys), 1))
+        agreements.append(set(utils.get_most_similar(ref)) == set(utils.get_most_similar(cand)))
+    return {
+        "vectors": len(ids),
+        "mean_cosine": float(np.mean(cosine)) if len(ids) else 1.0,
+        "min_cosine": float(np.min(cosine)) if len(ids) else 1.0,
+        "max_distance": float(np.max(distance)) if len(ids) else 0.0,
+        "neighbor_overlap@{}".format(k): float(np.mean(overlaps)) if len(ids) else 1.0,
+        "match_agreement": float(np.mean(agreements)) if len(ids) else 1.0
+    }
+
+
+if __name__ == "__main__":
+    # Run from the server directory:
+    #   python -m app.parsing.encoders export onnx|int8
+    #   python -m app.parsing.encoders validate onnx|int8 heldout1.txt heldout2.txt ...
+    import sys
+
+    if sys.argv[1] == "export":
+        {"onnx": export_onnx, "int8": export_int8}[sys.argv[2]]()
+    elif sys.argv[1] == "validate":
+        texts = []
+        for path in sys.argv[3:]:
+            with open(path, "r", encoding="utf-8") as f:
+                texts.append(f.read())
+        for name, value in validate(sys.argv[2], texts).items():
+            print("{:<20}{}".format(name, value))
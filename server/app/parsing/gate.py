@@ -0,0 +1,146 @@
+import re
+from collections import Counter, defaultdict
+from spacy.lang.en.stop_words import STOP_WORDS
+from app.database.database import open_database, get_all_claims, get_claims_version
+from app import config
+
+gate = None
+# The claims the gate was built from, see get_claims_version
+gate_version = None
+
+
+def normalize_term(word):
+    """
+    Lowercases a word and strips a plural s so that small inflections still match
+    """
+    word = word.lower()
+    if len(word) > 3 and word.endswith("s") and not word.endswith("ss"):
+        word = word[:-1]
+    return word
+
+
+def get_terms(words):
+    """
+    Returns the set of content terms in a list of words
+    """
+    return set(normalize_term(word) for word in words if word.isalnum() and word.lower() not in STOP_WORDS)
+
+
+class CandidateGate():
+    """
+    Cheap first stage of the pipeline. A sentence is only a candidate if it shares
+    enough content words with at least one stored claim, so most sentences on a page
+    never pay for coreference resolution, propositions and encoding
+    """
+
+    def __init__(self, claims, min_overlap=0.5):
+        """
+        claims: list of (id, text) pairs
+        min_overlap: the fraction of a claim's terms a sentence needs to share with it
+        """
+        self.min_overlap = min_overlap
+        self.postings = defaultdict(list)
+        self.claim_sizes = {}
+        for claim_id, text in claims:
+            terms = get_terms(re.findall(r"\w+", text))
+            self.claim_sizes[claim_id] = len(terms)
+            for term in terms:
+                self.postings[term].append(claim_id)
+
+    def score(self, span):
+        """
+        Returns the largest fraction of any claim's terms found in the span
+        """
+        shared = Counter()
+        for term in get_terms(token.text for token in span):
+            shared.update(self.postings.get(term, ()))
+        return max([count / self.claim_sizes[claim_id] for claim_id, count in shared.items()], default=0)
+
+    def is_candidate(self, span):
+        return self.score(span) >= self.min_overlap
+
+
+def get_gate():
+    """
+    Returns the gate built from the claims in the database, building it on first use
+    """
+    global gate, gate_version
+    if gate is None:
+        open_database()
+        gate_version = get_claims_version()
+        gate = CandidateGate(get_all_claims(), config["candidate_min_overlap"])
+    return gate
+
+
+def refresh_gate():
+    """
+    Rebuilds the gate if claims were added or removed since it was built, possibly by another process.
+    Worker processes never see reset_gate, so they call this once per batch
+    """
+    if gate is None or not config["candidate_gate"]:
+        return
+    open_database()
+    if get_claims_version() != gate_version:
+        reset_gate()
+
+
+def reset_gate():
+    """
+    Forces the gate to be rebuilt, e.g. after a claim was added
+    """
+    global gate
+    gate = None
+
+
+def is_candidate(span):
+    """
+    Checks a sentence against the gate, letting everything through if the gate is disabled
+    """
+    if not config["candidate_gate"]:
+        return True
+    return get_gate().is_candidate(span)
+
+
+def measure_recall(texts, thresholds=(0.2, 0.3, 0.4, 0.5, 0.6, 0.7)):
+    """
+    Runs the full pipeline on every valid sentence of the texts and reports, for each threshold,
+    the fraction of flagged sentences the gate lets through (recall) and the fraction of all
+    sentences it lets through (pass rate)
+    """
+    from app.parsing.parser import split_into_sentences, valid_sentence, lazy_coref_span
+    from app.parsing.sentence import Sentence
+    from app.database.utils import load_structures, get_similar_misinformation
+    load_structures()
+    scores, flagged = [], []
+    for text in texts:
+        for sent in split_into_sentences(text):
+            if not valid_sentence(sent):
+                continue
+            scores.append(get_gate().score(sent))
+            flagged.append(len(get_similar_misinformation(Sentence(sent, coref_span=lazy_coref_span(sent)))) > 0)
+    report = []
+    for threshold in thresholds:
+        passed = [score >= threshold for score in scores]
+        n_flagged = sum(flagged)
+        report.append({
+            "threshold": threshold,
+            "recall": sum(p and f for p, f in zip(passed, flagged)) / n_flagged if n_flagged else 1.0,
+            "pass_rate": sum(passed) / len(passed) if passed else 0.0,
+            "sentences": len(passed),
+            "flagged": n_flagged
+        })
+    return report
+
+
+if __name__ == "__main__":
+    # Run from the server directory: python -m app.parsing.gate article1.txt article2.txt ...
+    import sys
+
+    texts = []
+    for path in sys.argv[1:]:
+        with open(path, "r", encoding="utf-8") as f:
+            texts.append(f.read())
+    print("threshold  recall  pass_rate")
+    for row in measure_recall(texts):
+        print("{:9.2f}  {:6.3f}  {:9.3f}".format(row["threshold"], row["recall"], row["pass_rate"]))
+    print("{} sentences, {} flagged by the full pipeline".format(row["sentences"], row["flagged"]))
@@ -1,4 +1,5 @@
-from app.parsing.sentence import Sentence
+from app.parsing.sentence import Sentence, encode_sentences
+from app.parsing.gate import reset_gate
 
 import spacy
 import neuralcoref
@@ -6,20 +7,61 @@ import claucy
 from app.database.database import *
 import re
 import os
+import logging
+from bisect import bisect_right
 from io import StringIO
 from html.parser import HTMLParser
+from app import config
+from app.registry import register_model, get_model
 
-# Initialize SpaCy parsers
-nlp = spacy.load("en")
-neuralcoref.add_to_pipe(nlp, greedyness=0.5, blacklist=False)
-claucy.add_to_pipe(nlp)
 
+def load_nlp():
+    """
+    Puts together the SpaCy pipeline
+    """
+    nlp = get_model("spacy")
+    # In lazy mode coref only runs on the sentences that need it, see lazy_coref_span
+    if not config["lazy_coref"]:
+        nlp.add_pipe(get_model("neuralcoref"), name="neuralcoref")
+    else:
+        get_model("neuralcoref")
+    claucy.add_to_pipe(nlp, lazy=config["lazy_clauses"])
+    return nlp
+
+
+# Register the SpaCy parsers, they are loaded on first use
+register_model("spacy", lambda: spacy.load("en"))
+register_model("neuralcoref", lambda: neuralcoref.NeuralCoref(get_model("spacy").vocab, greedyness=0.5, blacklist=False))
+register_model("nlp", load_nlp)
+
+# Whether the fallback to one spaCy process was logged
+n_process_warned = False
 
-def parse_into_sentences(text):
+# Tokens that can refer back to something mentioned earlier
+ANAPHORS = set("he him his she her hers it its they them their theirs this that these those".split())
+
+
+def parse_into_sentences(text, encode=True):
     """
     Parses text into a set of valid sentences
+    encode: whether to encode the sentences here. Pass False to encode
+    the sentences of several texts together with encode_sentences
+    """
+    return parse_articles_into_sentences([text], encode=encode)
+
+
+def parse_articles_into_sentences(texts, encode=True):
+    """
+    Parses several texts into one list of valid sentences, feeding every
+    section of every text through the spaCy pipeline together
     """
-    return [Sentence(sent) for sent in split_into_sentences(text) if valid_sentence(sent)]
+    sections = []
+    for text in texts:
+        sections += split_into_sections(text)
+    sentences = [Sentence(sent, encode=False, coref_span=lazy_coref_span(sent)) for sents in pipe_sections(sections) for sent in sents if valid_sentence(sent)]
+    if encode:
+        encode_sentences(sentences)
+    return sentences
 
 
 def split_into_sentences(text, min_chars_per_element=15, min_words_per_element=4):
@@ -27,17 +69,66 @@ def split_into_sentences(text, min_chars_per_element=15, min_words_per_element=4
     Takes in a string
     Returns a list of setntences
     """
-    # Tokenize
     sents = []
-    for section in re.split("\t|\n|\r|\xa0|\x0b|\x0c", text):
-        if len(section) >= min_chars_per_element:
-            docx = nlp(section)
-            if len(docx) <= min_words_per_element:
-                continue
-            sents += list(docx.sents)
+    for section_sents in pipe_sections(split_into_sections(text, min_chars_per_element), min_words_per_element):
+        sents += section_sents
     return sents
 
 
+def split_into_sections(text, min_chars_per_element=15):
+    """
+    Splits text on control characters and drops the sections that are too short
+    """
+    return [section for section in re.split("\t|\n|\r|\xa0|\x0b|\x0c", text) if len(section) >= min_chars_per_element]
+
+
+def pipe_sections(sections, min_words_per_element=4, batch_size=None, n_process=None):
+    """
+    Streams sections through the spaCy pipeline with nlp.pipe
+    Yields the list of sentences of each section, in the same order as the sections
+    n_process > 1 needs every extension value set by the pipeline to be serializable,
+    so it only takes effect with lazy_coref and lazy_clauses, otherwise it falls back to 1
+    """
+    global n_process_warned
+    if batch_size is None:
+        batch_size = config["spacy_batch_size"]
+    if n_process is None:
+        n_process = config["spacy_n_process"]
+    if n_process > 1 and not (config["lazy_coref"] and config["lazy_clauses"]):
+        # spaCy sends docs back from its processes with msgpack, which cannot hold coref clusters or clauses
+        if not n_process_warned:
+            logging.warning("spacy_n_process > 1 needs lazy_coref and lazy_clauses, parsing in one process")
+            n_process_warned = True
+        n_process = 1
+    for docx in get_model("nlp").pipe(sections, batch_size=batch_size, n_process=n_process):
+        if len(docx) <= min_words_per_element:
+            yield []
+        else:
+            yield list(docx.sents)
+
+
+def has_anaphora(span):
+    """
+    Checks if there is a pronoun or demonstrative that could refer to an earlier mention
+    """
+    return any(token.lower_ in ANAPHORS and token.pos_ in ("PRON", "DET") for token in span)
+
+
+def lazy_coref_span(span):
+    """
+    Runs coreference resolution on the span and a bounded window of sentences before it
+    Returns the span in the resolved doc, or None if coref is not lazy or the span has no anaphora
+    """
+    if not config["lazy_coref"] or not has_anaphora(span):
+        return None
+    sent_starts = [sent.start for sent in span.doc.sents]
+    i = bisect_right(sent_starts, span.start) - 1
+    start = sent_starts[max(0, i - config["coref_window"])]
+    window = span.doc[start:span.end].as_doc()
+    get_model("neuralcoref")(window)
+    return window[span.start - start:span.end - start]
+
+
 def valid_sentence(sent):
     """
     Checks if there is a verb and two noun in the sent span
@@ -51,6 +142,32 @@ def valid_sentence(sent):
     return False
     
 
+def add_misinformation_batch(claims, clean_html=False, split=False):
+    """
+    Adds many claims at once. They are parsed and encoded together and inserted in a single transaction
+    claims: list of (misinfo, link, info)
+    """
+    open_database()
+    texts = [clean_misinformation(misinfo, clean_html) for misinfo, _, _ in claims]
+    spans = [docx[:] for docx in get_model("nlp").pipe(texts, batch_size=config["spacy_batch_size"])]
+    sentences = [Sentence(span, get_propositions=split, encode=False, coref_span=lazy_coref_span(span)) for span in spans]
+    encode_sentences(sentences)
+    insert_sentence_objects([(text, link, info, sentence.embeddings) for text, (_, link, info), sentence in zip(texts, claims, sentences)])
+    reset_gate()
+
+
+def clean_misinformation(misinfo, clean_html=False):
+    """
+    Cleans up the text of a claim before it is added
+    """
+    misinfo = misinfo.replace("\n", "").replace("\r", "").replace("\t", "")
+    if clean_html:
+        stripper = Misinformation.MLStripper()
+        stripper.feed(misinfo)
+        misinfo = stripper.get_data()
+    return misinfo
+
+
 class Misinformation():
     """
     Class for adding misinformation 
@@ -59,12 +176,13 @@ class Misinformation():
     def __init__(self, misinfo, link, info, clean_html=False, split=False):
         open_database() # Open database over here
         # Clean up the text
-        misinfo = misinfo.replace("\n", "").replace("\r", "").replace("\t", "")
-        if clean_html:
-            misinfo = self.strip_tags(misinfo)
+        misinfo = clean_misinformation(misinfo, clean_html)
         # Encode and put the stuff into the database
-        misinfo_sent = Sentence(nlp(misinfo)[:], get_propositions=split)
-        insert_sentence_object(misinfo, link, info, misinfo_sent.embeddings)
+        misinfo_span = get_model("nlp")(misinfo)[:]
+        misinfo_sent = Sentence(misinfo_span, get_propositions=split, coref_span=lazy_coref_span(misinfo_span))
+        self.embeddings = misinfo_sent.embeddings
+        self.start, self.end = insert_sentence_object(misinfo, link, info, misinfo_sent.embeddings)
+        reset_gate()
     def strip_tags(self, html):
         s = self.MLStripper()
         s.feed(html)
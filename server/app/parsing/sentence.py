@@ -1,11 +1,21 @@
 from transformers import DistilBertTokenizer
-from sentence_transformers import SentenceTransformer
 import os
-from itertools import combinations
+import threading
+from itertools import combinations, islice
 import numpy as np
+from app import config
+from app.registry import register_model, get_model
+from app.parsing.encoders import load_encoder, encode_batched
+from app.parsing.tokenization import FastTokenizer
 
-tokenizer = DistilBertTokenizer(os.path.join("app", "models", "0_Transformer", "vocab.txt"))
-model = SentenceTransformer(model_name_or_path=os.path.join("app", "models"))
+# Register the tokenizer and the encoder, they are loaded on first use
+register_model("tokenizer", lambda: DistilBertTokenizer(os.path.join("app", "models", "0_Transformer", "vocab.txt")))
+register_model("fast_tokenizer", FastTokenizer)
+register_model("encoder", load_encoder)
+
+# Counts of the propositions that were generated, and of the ones pruned before encoding
+proposition_stats = {"sentences": 0, "propositions": 0, "capped": 0, "duplicates": 0}
+stats_lock = threading.Lock()
 
 
 class Sentence():
@@ -13,30 +23,52 @@ class Sentence():
     Class for managing sentences
     """
 
-    def __init__(self, span, resolve_coreferences=True, get_propositions=True, max_length=None):
+    def __init__(self, span, resolve_coreferences=True, get_propositions=True, max_length=None, encode=True, coref_span=None):
         """
         resolve_coreferences: whether the detected coreferences should be resolved
-        max_length: the number of ids (includes the start token)
+        max_length: the number of ids (includes the start token), defaults to max_seq_length in the config
+        encode: whether to encode the ids right away, or leave it to encode_sentences
+        coref_span: a copy of span from a separately coref resolved doc, used instead of span to resolve coreferences
         """
 
         self.main_span = span
+        self.coref_span = coref_span
         self.embeddings = []
+        self.capped = 0
 
         if resolve_coreferences:
             self.tokens = self.resolve_coreferences(span)
         else:
             self.tokens = list(span)
         
-        self.ids = [self.get_ids(self.tokens)]
+        token_lists = [self.tokens]
         # Not used because of glitches in the python package
         if get_propositions:
-            props = self.get_propositions()
-            self.ids += [self.get_ids(proposition) for proposition in props]
+            token_lists += self.get_propositions()
+        self.ids = get_model("fast_tokenizer").get_ids(token_lists)
+
+        # Truncate long id lists, keeping the end of sequence id
+        if max_length is None:
+            max_length = config["max_seq_length"]
+        self.ids = [ids if len(ids) <= max_length else ids[:max_length - 1] + [102] for ids in self.ids]
 
-        #if max_length:
-        #    self.ids = ids[0][:max_length]
+        # Drop propositions that came out the same as the sentence or an earlier proposition
+        n_ids = len(self.ids)
+        unique, seen = [], set()
+        for ids in self.ids:
+            if tuple(ids) not in seen:
+                seen.add(tuple(ids))
+                unique.append(ids)
+        self.ids = unique
+        self.duplicates = n_ids - len(self.ids)
+        with stats_lock:
+            proposition_stats["sentences"] += 1
+            proposition_stats["propositions"] += n_ids - 1
+            proposition_stats["capped"] += self.capped
+            proposition_stats["duplicates"] += self.duplicates
 
-        self.embeddings = self.get_embeddings()
+        if encode:
+            self.embeddings = self.get_embeddings()
 
     def get_propositions(self):
         """
@@ -59,27 +91,31 @@ class Sentence():
                 prop += list(clause.direct_object)
             if clause.complement:
                 prop += list(clause.complement)
-            # If there are adverbials, then iterate through all possible combinations of them
-            # Messy way to do it but good enough for now
-            start = 0
-            for i in range(start, len(adverbials) + 1):
-                for combo in combinations(adverbials, i):
-                    ad = []
-                    for adverbial in combo:
-                        ad += list(adverbial)
-                    props.append(prop + ad)
+            # If there are adverbials, then iterate through the combinations of them, smallest first
+            # Clauses with many adverbials have exponentially many, so only take as many as the caps allow
+            max_size = min(len(adverbials), config["max_adverbials_per_proposition"])
+            combos = (combo for i in range(max_size + 1) for combo in combinations(adverbials, i))
+            n_combos = 0
+            for combo in islice(combos, max(0, min(config["max_adverbial_combinations"], config["max_propositions"] - len(props)))):
+                ad = []
+                for adverbial in combo:
+                    ad += list(adverbial)
+                props.append(prop + ad)
+                n_combos += 1
+            self.capped += 2 ** len(adverbials) - n_combos
         return [self.resolve_coreferences(prop) for prop in props]
 
     def get_embeddings(self):
         """
         Puts the tokenized ids through the DistilBert model
         """
-        return  model.encode(self.ids, is_pretokenized=True, convert_to_numpy=True)
+        return encode_batched(get_model("encoder"), self.ids)
 
     def resolve_coreferences(self, sent):
         """
         Create a list of words with coreferences replaced with main reference in cluster
         """
+        sent = [self._get_coref_token(token) for token in sent]
         tokens = []
         i = 0
         while i < len(sent):
@@ -98,27 +134,29 @@ class Sentence():
                 i += 1
         return [token for token in tokens]
         
+    def _get_coref_token(self, token):
+        """
+        Returns the token from the doc that holds the coreferences
+        """
+        if self.coref_span is None:
+            return token
+        i = token.i - self.main_span.start
+        if 0 <= i < len(self.coref_span):
+            return self.coref_span[i]
+        return token
+
     def get_ids(self, tokens):
         """
         Converts coreference resolved tokens to their Albert Tokenizer ids.
         Allos us to feed these into the model
         """
-        # We start out with a list of ids only containing the begining of sequence id
-        ids = [101]
-        for token in tokens:
-            token_id = tokenizer._convert_token_to_id(token.text.lower())
-            if token_id != 100:
-                ids.append(token_id)
-            else:
-                # for works with unknown ids, try to split it into parts using the sentpiece tokenizer
-                ids += tokenizer(token.text)["input_ids"][1:-1]
-        # Return with end of sequence id at the end
-        return ids + [102]
+        return get_model("fast_tokenizer").get_ids([tokens])[0]
 
     def _convert_ids_to_tokens(self):
         """
         Returns a list of the tokens in the ids list converted to strings
         """
+        tokenizer = get_model("tokenizer")
         return [ [tokenizer._convert_id_to_token(i) for i in ids] for ids in self.ids]
 
     def _get_distance(self, sentence):
@@ -132,3 +170,28 @@ class Sentence():
         Converts the sentence to a string
         """
         return self.main_span.text
+
+
+def get_proposition_stats():
+    """
+    Returns the proposition counts of every sentence built so far
+    """
+    with stats_lock:
+        return dict(proposition_stats)
+
+
+def encode_sentences(sentences, batch_size=None):
+    """
+    Encodes the ids of many sentences in as few model calls as possible,
+    then gives each sentence its slice of the embedding matrix
+    """
+    # Collect the ids of every sentence and proposition, in sentence order
+    ids = [sentence_ids for sentence in sentences for sentence_ids in sentence.ids]
+    embeddings = encode_batched(get_model("encoder"), ids, batch_size)
+    # Hand out the slices
+    start = 0
+    for sentence in sentences:
+        end = start + len(sentence.ids)
+        sentence.embeddings = embeddings[start:end]
+        start = end
+    return sentences
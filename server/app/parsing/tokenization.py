@@ -0,0 +1,102 @@
+import os
+import threading
+from tokenizers import BertWordPieceTokenizer
+from app import config
+
+VOCAB_PATH = os.path.join("app", "models", "0_Transformer", "vocab.txt")
+
+
+class FastTokenizer():
+    """
+    Turns spaCy tokens into DistilBert ids with the Rust backed wordpiece tokenizer.
+    Gives the same ids as looking each lowercased token up in the vocab and running
+    the slow DistilBertTokenizer on the ones that are not in it, but tokenizes all
+    the unknown words of a batch in one call and remembers every word it has seen
+    """
+
+    def __init__(self, vocab_path=VOCAB_PATH, cache_size=None):
+        # Read the vocab the same way DistilBertTokenizer does
+        self.vocab = {}
+        with open(vocab_path, "r", encoding="utf-8") as f:
+            for index, line in enumerate(f):
+                self.vocab[line.rstrip("\n")] = index
+        self.unk_id = self.vocab["[UNK]"]
+        self.tokenizer = BertWordPieceTokenizer(vocab_path, lowercase=True)
+        self.cache = {}
+        self.cache_size = cache_size if cache_size is not None else config["token_cache_size"]
+        self.lock = threading.Lock()
+
+    def get_word_ids(self, words):
+        """
+        Returns a dict from each word to its list of ids
+        """
+        with self.lock:
+            word_ids = {word: self.cache[word] for word in words if word in self.cache}
+        unknown = []
+        for word in set(words):
+            if word in word_ids:
+                continue
+            token_id = self.vocab.get(word.lower(), self.unk_id)
+            if token_id != self.unk_id:
+                word_ids[word] = [token_id]
+            else:
+                unknown.append(word)
+        # Split the words that are not in the vocab into wordpieces, all at once
+        if unknown:
+            for word, encoding in zip(unknown, self.tokenizer.encode_batch(unknown, add_special_tokens=False)):
+                word_ids[word] = encoding.ids
+        with self.lock:
+            if len(self.cache) + len(word_ids) > self.cache_size:
+                self.cache.clear()
+            self.cache.update(word_ids)
+        return word_ids
+
+    def get_ids(self, token_lists):
+        """
+        Converts lists of spaCy tokens to id lists wrapped in the start and end of sequence ids
+        """
+        word_ids = self.get_word_ids([token.text for tokens in token_lists for token in tokens])
+        id_lists = []
+        for tokens in token_lists:
+            ids = [101]
+            for token in tokens:
+                ids += word_ids[token.text]
+            id_lists.append(ids + [102])
+        return id_lists
+
+
+def reference_word_ids(tokenizer, word):
+    """
+    How Sentence.get_ids used to turn a word into ids with the slow tokenizer
+    """
+    token_id = tokenizer._convert_token_to_id(word.lower())
+    if token_id != 100:
+        return [token_id]
+    return tokenizer(word)["input_ids"][1:-1]
+
+
+def check_parity(words):
+    """
+    Returns the words for which the fast tokenizer and the slow tokenizer give different ids
+    """
+    from app.registry import get_model
+    slow = get_model("tokenizer")
+    fast = FastTokenizer().get_word_ids(words)
+    return [(word, reference_word_ids(slow, word), fast[word]) for word in set(words) if reference_word_ids(slow, word) != fast[word]]
+
+
+if __name__ == "__main__":
+    # Run from the server directory: python -m app.parsing.tokenization text1.txt text2.txt ...
+    import sys
+    from app.registry import get_model
+    import app.parsing.parser
+
+    words = []
+    for path in sys.argv[1:]:
+        with open(path, "r", encoding="utf-8") as f:
+            words += [token.text for token in get_model("spacy").tokenizer(f.read())]
+    mismatches = check_parity(words)
+    for word, slow_ids, fast_ids in mismatches:
+        print("{!r}: slow {} fast {}".format(word, slow_ids, fast_ids))
+    print("{} distinct words, {} mismatches".format(len(set(words)), len(mismatches)))
+    sys.exit(1 if mismatches else 0)
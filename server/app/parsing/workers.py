@@ -0,0 +1,83 @@
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from app import config
+from app.registry import load_models
+from app.parsing.parser import pipe_sections, valid_sentence, lazy_coref_span
+from app.parsing.sentence import Sentence, encode_sentences
+from app.parsing.gate import is_candidate, refresh_gate
+
+pool = None
+
+
+class EncodedSentence():
+    """
+    Picklable stand-in for a Sentence that only keeps its text and embeddings,
+    which is all the search needs
+    """
+
+    def __init__(self, text, embeddings):
+        self.text = text
+        self.embeddings = embeddings
+
+    def __str__(self):
+        return self.text
+
+
+def encode_sections(sections):
+    """
+    Parses and encodes sections
+    Returns the list of valid candidate sentences of each section, in the same order as the sections
+    """
+    refresh_gate()
+    section_sentences = [[Sentence(sent, encode=False, coref_span=lazy_coref_span(sent)) for sent in sents if valid_sentence(sent) and is_candidate(sent)] for sents in pipe_sections(sections)]
+    encode_sentences([sentence for sentences in section_sentences for sentence in sentences])
+    return section_sentences
+
+
+def encode_sections_in_pool(sections):
+    """
+    Shards the sections across the worker processes and merges their sentences back in document order
+    Falls back to encoding in this process if the pool is disabled
+    """
+    n_workers = config["inference_processes"]
+    if n_workers <= 1 or len(sections) < 2:
+        return encode_sections(sections)
+    # Contiguous shards of roughly equal amounts of text
+    shards = [[] for _ in range(min(n_workers, len(sections)))]
+    shard_chars = sum(len(section) for section in sections) / len(shards)
+    chars = 0
+    for section in sections:
+        shards[min(int(chars / shard_chars), len(shards) - 1)].append(section)
+        chars += len(section)
+    section_sentences = []
+    for shard_sentences in get_pool().map(encode_shard, [shard for shard in shards if shard]):
+        section_sentences += [[EncodedSentence(text, embeddings) for text, embeddings in sentences] for sentences in shard_sentences]
+    return section_sentences
+
+
+def encode_shard(sections):
+    """
+    Runs in a worker process. Returns plain (text, embeddings) pairs so the result can be pickled
+    """
+    return [[(str(sentence), sentence.embeddings) for sentence in sentences] for sentences in encode_sections(sections)]
+
+
+def init_worker():
+    """
+    Loads the models once when a worker process starts
+    """
+    import torch
+    # Every process gets its own core, so keep torch from spawning threads on the others
+    torch.set_num_threads(1)
+    load_models(parallel=False)
+
+
+def get_pool():
+    """
+    Returns the worker pool, starting it on first use
+    """
+    global pool
+    if pool is None:
+        context = multiprocessing.get_context(config["inference_start_method"])
+        pool = ProcessPoolExecutor(max_workers=config["inference_processes"], mp_context=context, initializer=init_worker)
+    return pool
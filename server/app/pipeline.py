@@ -0,0 +1,115 @@
+from app.parsing.parser import split_into_sections
+from app.parsing.workers import encode_sections_in_pool
+from app.database.utils import get_similar_misinformation_batch, ensure_structures
+from app.registry import load_models, timed
+from app import config
+from app.database.cache import verdict_cache
+import hashlib
+
+
+def check_articles(article_arr):
+    """
+    Runs the fact checking pipeline over a list of texts
+    Returns a record for every sentence that has similar misinformation
+    """
+    return list(iter_check_articles(article_arr))
+
+
+def iter_check_articles(article_arr, chunk_size=None):
+    """
+    Generator version of check_articles that yields each record as soon as its section has been searched
+    chunk_size: the number of sections parsed and encoded together, or None to do all of them at once
+    """
+    sections = []
+    for article in article_arr:
+        sections += split_into_sections(article)
+    if chunk_size is None:
+        chunk_size = max(len(sections), 1)
+    for i in range(0, len(sections), chunk_size):
+        for records in check_cached_sections(sections[i:i + chunk_size]):
+            yield from records
+
+
+def paragraph_digest(paragraph):
+    """
+    The hash the extension uses to refer to a paragraph: the SHA-256 of its UTF-8 text
+    """
+    return hashlib.sha256(paragraph.encode("utf-8")).hexdigest()
+
+
+def check_paragraphs(paragraphs):
+    """
+    Checks paragraphs sent by the extension and stores their records under their hashes
+    paragraphs: dict of paragraph hash to paragraph text
+    Returns a dict of paragraph hash to the records of the paragraph
+    """
+    digests = list(paragraphs)
+    paragraph_sections = [split_into_sections(paragraphs[digest]) for digest in digests]
+    section_records = check_cached_sections([section for sections in paragraph_sections for section in sections])
+    results = {}
+    for digest, sections in zip(digests, paragraph_sections):
+        records = []
+        for _ in sections:
+            records += next(section_records)
+        results[digest] = records
+        verdict_cache.put_digest(digest, records)
+    return results
+
+
+def check_cached_sections(sections):
+    """
+    Yields the list of records of each section, going through the verdict cache
+    """
+    # Look up every distinct section in the verdict cache
+    verdicts = {}
+    for section in sections:
+        if section not in verdicts:
+            verdicts[section] = verdict_cache.get(section)
+    missing = [section for section, verdict in verdicts.items() if verdict is None]
+    # Cached sections at the start can be returned before any parsing happens
+    i = 0
+    while i < len(sections) and verdicts[sections[i]] is not None:
+        yield verdicts[sections[i]]
+        i += 1
+    # Run the sections we have not seen before through the whole stack
+    for section, verdict in zip(missing, check_sections(missing)):
+        verdicts[section] = verdict
+        verdict_cache.put(section, verdict)
+        # Return everything that is now ready, in document order
+        while i < len(sections) and verdicts[sections[i]] is not None:
+            yield verdicts[sections[i]]
+            i += 1
+
+
+def check_sections(sections):
+    """
+    Parses, encodes and searches sections
+    Yields the list of records of each section, in the same order as the sections
+    """
+    section_sentences = encode_sections_in_pool(sections)
+    # One search and one claim lookup for the vectors of every section
+    sentences = [sentence for sentences in section_sentences for sentence in sentences]
+    searches = get_similar_misinformation_batch(sentences)
+    # Split the results back up by section
+    start = 0
+    for section in section_sentences:
+        end = start + len(section)
+        records = []
+        for sentence, search in zip(sentences[start:end], searches[start:end]):
+            if len(search) > 0:
+                records.append({
+                    "sentence": str(sentence),
+                    "results": search
+                })
+        start = end
+        yield records
+
+
+def warmup():
+    """
+    Loads every model and the index, then runs a dummy batch through the whole
+    pipeline so the first request does not pay for any of it
+    """
+    timed("models", load_models, None, config["parallel_model_loading"])
+    timed("index", ensure_structures)
+    timed("warmup", lambda: list(check_sections(["The quick brown fox jumps over the lazy dog because the dog was asleep."])))
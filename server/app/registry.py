@@ -0,0 +1,63 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+loaders = {}
+models = {}
+locks = {}
+load_times = {}
+
+
+def register_model(name, loader):
+    """
+    Registers a function that loads a model. Nothing is loaded until the model is first needed
+    """
+    loaders[name] = loader
+    locks[name] = threading.Lock()
+
+
+def get_model(name):
+    """
+    Returns the model with the given name, loading it on first use
+    """
+    if name in models:
+        return models[name]
+    with locks[name]:
+        if name not in models:
+            start = time.perf_counter()
+            model = loaders[name]()
+            load_times[name] = time.perf_counter() - start
+            models[name] = model
+    return models[name]
+
+
+def load_models(names=None, parallel=True):
+    """
+    Loads the given models, or every registered model, in parallel threads if asked to
+    """
+    if names is None:
+        names = list(loaders)
+    if parallel:
+        with ThreadPoolExecutor(max_workers=len(names) or 1) as executor:
+            list(executor.map(get_model, names))
+    else:
+        for name in names:
+            get_model(name)
+
+
+def timed(name, function, *args):
+    """
+    Calls a function and records how long it took next to the model load times
+    """
+    start = time.perf_counter()
+    result = function(*args)
+    load_times[name] = time.perf_counter() - start
+    return result
+
+
+def format_load_times():
+    """
+    Returns a table of how long each component took to load.
+    Models that are loaded by other models include the time of their dependencies
+    """
+    return "\n".join("{:<16}{:8.2f}s".format(name, seconds) for name, seconds in sorted(load_times.items(), key=lambda item: -item[1]))
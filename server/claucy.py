@@ -87,6 +87,20 @@ scarcely
 seldom
 rarely""".split(),
 }
+# Lexicons are only used for membership tests
+dictionary = {name: frozenset(words) for name, words in dictionary.items()}
+
+SUBJECT_DEPS = frozenset(["nsubj", "nsubjpass"])
+ALL_SUBJECT_DEPS = frozenset(["nsubj", "nsubj:pass", "nsubjpass"])
+CLAUSE_LINK_DEPS = frozenset(["conj", "cc", "advcl", "acl", "ccomp"])
+MODIFIER_CLAUSE_DEPS = frozenset(["acl", "advcl"])
+INDIRECT_OBJECT_DEPS = frozenset(["dative"])
+DIRECT_OBJECT_DEPS = frozenset(["dobj"])
+COMPLEMENT_DEPS = frozenset(["ccomp", "acomp", "xcomp", "attr"])
+ADVERBIAL_DEPS = frozenset(["prep", "advmod", "agent"])
+
+# Verb phrase matchers, built once per vocab
+_verb_matchers = {}
 
 
 class Clause:
@@ -345,44 +359,50 @@ def _convert_clauses_to_text(propositions, inflect, capitalize):
     return proposition_texts
 
 
-def _get_verb_matches(span):
+def _get_verb_matcher(vocab):
     # 1. Find verb phrases in the span
     # (see mdmjsh answer here: https://stackoverflow.com/questions/47856247/extract-verb-phrases-using-spacy)
+    if vocab not in _verb_matchers:
+        verb_matcher = Matcher(vocab)
+        verb_matcher.add(
+            "Auxiliary verb phrase aux-verb", None, [{"POS": "AUX"}, {"POS": "VERB"}]
+        )
+        verb_matcher.add("Auxiliary verb phrase", None, [{"POS": "AUX"}])
+        verb_matcher.add("Verb phrase", None, [{"POS": "VERB"}])
+        _verb_matchers[vocab] = verb_matcher
+    return _verb_matchers[vocab]
 
-    verb_matcher = Matcher(span.vocab)
-    verb_matcher.add(
-        "Auxiliary verb phrase aux-verb", None, [{"POS": "AUX"}, {"POS": "VERB"}]
-    )
-    verb_matcher.add("Auxiliary verb phrase", None, [{"POS": "AUX"}])
-    verb_matcher.add("Verb phrase", None, [{"POS": "VERB"}])
 
-    return verb_matcher(span)
+def _get_verb_matches(span):
+    return _get_verb_matcher(span.vocab)(span)
 
 
 def _get_verb_chunks(span):
     matches = _get_verb_matches(span)
     # Filter matches (e.g. do not have both "has won" and "won" in verbs)
     verb_chunks = []
+    roots = set()
     for match in [span[start:end] for _, start, end in matches]:
-        if match.root not in [vp.root for vp in verb_chunks]:
+        if match.root.i not in roots:
+            roots.add(match.root.i)
             verb_chunks.append(match)
     return verb_chunks
 
 
 def _get_subject(verb):
     for c in verb.root.children:
-        if c.dep_ in ["nsubj", "nsubjpass"]:
+        if c.dep_ in SUBJECT_DEPS:
             subject = extract_span_from_entity(c)
             return subject
 
     root = verb.root
-    while root.dep_ in ["conj", "cc", "advcl", "acl", "ccomp"]:
+    while root.dep_ in CLAUSE_LINK_DEPS:
         for c in root.children:
-            if c.dep_ in ["nsubj", "nsubjpass"]:
+            if c.dep_ in SUBJECT_DEPS:
                 subject = extract_span_from_entity(c)
                 return subject
 
-            if c.dep_ in ["acl", "advcl"]:
+            if c.dep_ in MODIFIER_CLAUSE_DEPS:
                 verb_subj = find_verb_subject(c)
                 if verb_subj != None:
                     return extract_span_from_entity(verb_subj)
@@ -395,7 +415,7 @@ def _get_subject(verb):
             root = verb.root.head
 
     for c in root.children:
-        if c.dep_ in ["nsubj", "nsubj:pass", "nsubjpass"]:
+        if c.dep_ in ALL_SUBJECT_DEPS:
             subject = extract_span_from_entity(c)
             return subject
     return None
@@ -427,12 +447,12 @@ def extract_clauses(span):
                 clause = Clause(subject=subject, complement=complement)
                 clauses.append(clause)
 
-        indirect_object = _find_matching_child(verb.root, ["dative"])
-        direct_object = _find_matching_child(verb.root, ["dobj"])
-        complement = _find_matching_child(verb.root, ["ccomp", "acomp", "xcomp", "attr"])
+        indirect_object = _find_matching_child(verb.root, INDIRECT_OBJECT_DEPS)
+        direct_object = _find_matching_child(verb.root, DIRECT_OBJECT_DEPS)
+        complement = _find_matching_child(verb.root, COMPLEMENT_DEPS)
         adverbials = [extract_span_from_entity(c)
                       for c in verb.root.children
-                      if c.dep_ in ("prep", "advmod", "agent")]
+                      if c.dep_ in ADVERBIAL_DEPS]
 
         clause = Clause(
             subject=subject,
@@ -445,26 +465,65 @@ def extract_clauses(span):
     return clauses
 
 
+def _extract_clauses_safely(sent):
+    # A sentence that trips up the extractor just has no clauses
+    try:
+        return extract_clauses(sent)
+    except Exception:
+        logging.exception("Could not extract clauses from: %s", sent)
+        return []
+
+
 def extract_clauses_doc(doc):
+    doc_clauses = []
     for sent in doc.sents:
-        try:
-            clauses = extract_clauses(sent)
-        except Exception as e:
-            print(e)
-            print(sent)
-            quit()
+        clauses = _extract_clauses_safely(sent)
         sent._.clauses = clauses
-        doc._.clauses += clauses
+        doc_clauses += clauses
+    doc._.clauses = doc_clauses
     return doc
 
 
-def add_to_pipe(nlp):
-    nlp.add_pipe(extract_clauses_doc)
+def _get_span_clauses(span):
+    # Like the pipe, only sentences have clauses. They are extracted on first access and kept in the doc
+    sent = span[0].sent if len(span) else None
+    if sent is None or sent.start != span.start or sent.end != span.end:
+        return []
+    key = ("claucy_clauses", span.start, span.end)
+    if key not in span.doc.user_data:
+        span.doc.user_data[key] = _extract_clauses_safely(span)
+    return span.doc.user_data[key]
+
+
+def _get_doc_clauses(doc):
+    clauses = []
+    for sent in doc.sents:
+        clauses += sent._.clauses
+    return clauses
+
+
+def add_to_pipe(nlp, lazy=False):
+    """
+    Adds clause extraction to a pipeline.
+    lazy: instead of a pipe that extracts the clauses of every sentence, make Doc._.clauses
+    and Span._.clauses getters that extract them the first time they are asked for
+    """
+    if lazy:
+        Doc.set_extension("clauses", getter=_get_doc_clauses, force=True)
+        Span.set_extension("clauses", getter=_get_span_clauses, force=True)
+    else:
+        nlp.add_pipe(extract_clauses_doc)
 
 
 def extract_span_from_entity(token):
-    ent_subtree = sorted([c for c in token.subtree], key=lambda x: x.i)
-    return Span(token.doc, start=ent_subtree[0].i, end=ent_subtree[-1].i + 1)
+    # The bounds of each subtree are worked out once per doc
+    key = ("claucy_subtree", token.i)
+    bounds = token.doc.user_data.get(key)
+    if bounds is None:
+        indices = [c.i for c in token.subtree]
+        bounds = (min(indices), max(indices) + 1)
+        token.doc.user_data[key] = bounds
+    return Span(token.doc, start=bounds[0], end=bounds[1])
 
 
 def extract_span_from_entity_no_cc(token):
@@ -516,24 +575,86 @@ def find_verb_subject(v, last=None):
     find the subject of that verb instead. 
     """
 
-    if v.dep_ in ["nsubj", "nsubjpass", "nsubj:pass"]:
+    if v.dep_ in ALL_SUBJECT_DEPS:
         return v
-    elif v.dep_ in ["advcl", "acl"]:
+    elif v.dep_ in MODIFIER_CLAUSE_DEPS:
         return find_verb_subject(v.head, last=v)
 
     for c in v.children:
-        if c.dep_ in ["nsubj", "nsubjpass", "nsubj:pass"]:
+        if c.dep_ in ALL_SUBJECT_DEPS:
             return c
         # I did this and Im not sure why it works but it fixed the problem
-        elif c.dep_ in ["advcl", "acl"] and v.head != last:
+        elif c.dep_ in MODIFIER_CLAUSE_DEPS and v.head != last:
             return find_verb_subject(v.head, last=v)
 
 
 
+BENCHMARK_CORPUS = [
+    "Chester is a banker by trade, but is dreaming of becoming a great dancer.",
+    " A cat , hearing that the birds in a certain aviary were ailing dressed himself up as a physician , and , taking his cane and a bag of instruments becoming his profession , went to call on them .",
+    "The vaccine was developed in under a year by researchers at several universities and was tested on thousands of volunteers.",
+    "According to the report, the senator voted against the bill in March because he believed it would raise taxes for families.",
+    "Scientists have found no evidence that the towers spread the virus, despite claims made on social media.",
+    "She gave the committee a detailed account of the events that took place in the capital last week.",
+    "The company, which was founded in 1998, announced on Tuesday that it would close three of its factories in the region.",
+    "Drinking hot water every fifteen minutes does not cure the disease, doctors warned in a statement released on Friday.",
+]
+
+
+def benchmark(nlp, texts=BENCHMARK_CORPUS, repeat=20, baseline=None):
+    """
+    Times clause extraction over a fixed corpus of parsed sentences.
+    baseline: another version of this module, e.g. an older claucy.py loaded with importlib,
+    to time against and to check that both produce the same clauses
+    """
+    import time
+
+    docs = list(nlp.pipe(texts))
+    sents = [sent for doc in docs for sent in doc.sents]
+    implementations = [("compiled", extract_clauses)]
+    if baseline is not None:
+        implementations.append(("baseline", baseline.extract_clauses))
+    timings = {}
+    for name, extract in implementations:
+        elapsed = 0
+        for _ in range(repeat):
+            # Every pass starts without memoized subtrees, like a freshly parsed doc
+            for doc in docs:
+                for key in [key for key in doc.user_data if isinstance(key, tuple) and key[0] == "claucy_subtree"]:
+                    del doc.user_data[key]
+            start = time.perf_counter()
+            for sent in sents:
+                extract(sent)
+            elapsed += time.perf_counter() - start
+        timings[name] = elapsed / (repeat * len(sents))
+    if baseline is not None:
+        for sent in sents:
+            if repr(extract_clauses(sent)) != repr(baseline.extract_clauses(sent)):
+                raise AssertionError("Clauses differ from the baseline for: {}".format(sent))
+    return timings
+
+
 if __name__ == "__main__":
+    import sys
     import spacy
 
     nlp = spacy.load("en")
+
+    if len(sys.argv) > 1 and sys.argv[1] == "--benchmark":
+        # python claucy.py --benchmark [old_claucy.py]
+        baseline = None
+        if len(sys.argv) > 2:
+            import importlib.util
+            spec = importlib.util.spec_from_file_location("claucy_baseline", sys.argv[2])
+            baseline = importlib.util.module_from_spec(spec)
+            spec.loader.exec_module(baseline)
+        timings = benchmark(nlp, baseline=baseline)
+        for name, seconds in timings.items():
+            print("{:<10}{:10.1f} us per sentence".format(name, seconds * 1e6))
+        if baseline is not None:
+            print("speedup   {:10.2f}x".format(timings["baseline"] / timings["compiled"]))
+        sys.exit(0)
+
     add_to_pipe(nlp)
 
     doc = nlp(
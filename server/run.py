@@ -1,3 +1,13 @@
+import os
 from app import app, config
+from app.pipeline import warmup
+from app.registry import format_load_times
 
-app.run(host=config["ip_address"], port=config["port"], debug=True)
\ No newline at end of file
+# Spawned inference workers import this file as __mp_main__, so only the main process may serve
+if __name__ == "__main__":
+    # The reloader runs this file twice, only warm up the process that serves requests
+    if config["warmup"] and os.environ.get("WERKZEUG_RUN_MAIN") == "true":
+        warmup()
+        print(format_load_times())
+
+    app.run(host=config["ip_address"], port=config["port"], debug=True)